@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Time parsing, card loading, pack evaluation and file output for every example def file.
+
+Each def file is run against the cube scaled up 1, 10 and 100 times by copying every card under new
+multiverse ids. Colors come from a stub source backed by the real color.cache, so nothing is
+fetched. Results are printed as JSON, or written with --out, along with the commit they were taken
+at. Pass --compare with an earlier result file to see the change for every measurement.
+
+Run with `./benchmarks/evaluator.py [--scales 1,10,100] [--packs N] [--repeat N]`.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import gatherer  # noqa: E402
+import parsertree  # noqa: E402
+
+from packbuilder import write_dec_stream  # noqa: E402
+from treecache import TreeCache  # noqa: E402
+
+# Copies of a card get mvids offset by multiples of this, above any real multiverse id
+mvid_stride = 10 ** 7
+timings = ['parse_ms', 'load_ms', 'cached_load_ms', 'pack_ms', 'write_ms']
+
+
+class StubFetcher():
+    """
+    Stands in for GathererFetcher, answering from the real color cache by the original mvid.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.fetched = 0
+
+    def fetch(self, mvid):
+        res = self.store.get(str(int(mvid) % mvid_stride))
+        if res is None:
+            raise KeyError('No colors for mvid {}'.format(mvid))
+        self.fetched += 1
+        return res
+
+    def fetch_all(self, mvids):
+        res = {}
+        errors = {}
+        for mvid in mvids:
+            try:
+                res[mvid] = self.fetch(mvid)
+            except KeyError as e:
+                errors[mvid] = e
+        return res, errors
+
+
+def scale_card(card_lines, copy):
+    if copy == 0:
+        return card_lines
+    mvid = int(gatherer.card_mvid(card_lines))
+    new_mvid = mvid + copy * mvid_stride
+    card_lines = card_lines.replace('mvid:{}'.format(mvid), 'mvid:{}'.format(new_mvid), 1)
+    comment, name_line = card_lines.split('\n', 1)
+    comment = re.sub(' loc:', ' ({}) loc:'.format(copy), comment, count=1)
+    return '{}\n{} ({})\n'.format(comment, name_line.rstrip('\n'), copy)
+
+
+def build_cube(dest, scale):
+    """
+    Write the rarity directories with every card repeated scale times, returning the card count.
+    """
+    count = 0
+    for rare_file in glob.glob(os.path.join(root, '*s/*.dec')):
+        rarity = os.path.basename(os.path.dirname(rare_file))
+        os.makedirs(os.path.join(dest, rarity), exist_ok=True)
+        with open(rare_file) as inp:
+            lines = inp.readlines()
+        cards = [lines[i] + lines[i + 1] for i in range(0, len(lines) - 1, 2)]
+        with open(os.path.join(dest, rarity, os.path.basename(rare_file)), 'w') as out:
+            for copy in range(scale):
+                out.write(''.join(scale_card(cd, copy) for cd in cards))
+        count += len(cards) * scale
+    return count
+
+
+def median_ms(fun, repeat):
+    times = []
+    res = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = fun()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000, res
+
+
+def make_packs(tree, n, seed):
+    """
+    Build n packs, starting over with a full cube whenever this one runs out.
+    """
+    tree = parsertree.compile_tree(tree)
+    packs = []
+    restarts = 0
+    while len(packs) < n:
+        ctx = parsertree.Context('{}:{}'.format(seed, restarts))
+        made = 0
+        while len(packs) < n:
+            pack = []
+            try:
+                tree.eval(pack, ctx)
+            except ValueError:
+                break
+            packs.append(pack)
+            made += 1
+        if made == 0:
+            break
+        restarts += 1
+    return packs, restarts
+
+
+def bench_def(def_file, cube_dir, cards, args):
+    with open(def_file) as inp:
+        contents = inp.read()
+    res = {'def': os.path.relpath(def_file, root), 'cards': cards}
+    parse = lambda: parsertree.parser.parse(contents, lexer=parsertree.lexer)
+    res['parse_ms'], _ = median_ms(parse, args.repeat)
+    # The first load resolves colors through the stub, later ones find them in the color cache
+    parsertree.create_tree(def_file, None)
+    load_ms, tree = median_ms(lambda: parsertree.create_tree(def_file, None), args.repeat)
+    res['load_ms'] = load_ms - res['parse_ms']
+
+    cache = TreeCache(os.path.join(cube_dir, '.treecache'))
+    parsertree.create_tree(def_file, cache)
+    res['cached_load_ms'], _ = median_ms(lambda: parsertree.create_tree(def_file, cache),
+                                         args.repeat)
+
+    start = time.perf_counter()
+    packs, restarts = make_packs(tree, args.packs, args.seed)
+    res['packs'] = len(packs)
+    res['restarts'] = restarts
+    res['pack_ms'] = (time.perf_counter() - start) * 1000 / max(len(packs), 1)
+
+    out_dir = os.path.join(cube_dir, 'results')
+
+    def write():
+        shutil.rmtree(out_dir, ignore_errors=True)
+        write_dec_stream((tree.cards.dec_lines(pack) for pack in packs), out_dir, 8)
+    res['write_ms'], _ = median_ms(write, args.repeat)
+    return res
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, out=sys.stderr):
+    """
+    Print the ratio of every timing in new to the same timing in old.
+    """
+    old_rows = {(row['def'], row['scale']): row for row in old['results']}
+    out.write('Compared with {}\n'.format(old.get('commit')))
+    for row in new['results']:
+        old_row = old_rows.get((row['def'], row['scale']))
+        if old_row is None:
+            continue
+        changes = ' '.join('{} {:.2f}x'.format(key[:-3], row[key] / old_row[key])
+                           for key in timings if old_row.get(key))
+        out.write('{:<32} x{:<4} {}\n'.format(row['def'], row['scale'], changes))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('defs', nargs='*', help='Def files to run, by default every example')
+    arg_parser.add_argument('--scales', default='1,10,100',
+                            help='Comma separated cube sizes to run at')
+    arg_parser.add_argument('--packs', type=int, default=50,
+                            help='Packs to evaluate for each def file')
+    arg_parser.add_argument('--repeat', type=int, default=5, help='Runs to take the median time of')
+    arg_parser.add_argument('--seed', default='benchmark')
+    arg_parser.add_argument('--out', default=None, help='File to write the results to')
+    arg_parser.add_argument('--compare', default=None, help='Earlier results to compare against')
+    args = arg_parser.parse_args()
+
+    defs = [os.path.abspath(d) for d in args.defs]
+    if len(defs) == 0:
+        defs = sorted(glob.glob(os.path.join(root, 'examples', '*.def')))
+    gatherer.fetcher = StubFetcher(gatherer.ColorStore(os.path.join(root, 'color.cache')))
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': parsertree.vector_support(),
+        'packs': args.packs,
+        'repeat': args.repeat,
+        'results': [],
+    }
+    cwd = os.getcwd()
+    for scale in [int(s) for s in args.scales.split(',')]:
+        with tempfile.TemporaryDirectory() as cube_dir:
+            cards = build_cube(cube_dir, scale)
+            # Rarity directories are found relative to the working directory
+            os.chdir(cube_dir)
+            gatherer.color_store = gatherer.ColorStore(os.path.join(cube_dir, 'color.cache'))
+            try:
+                for def_file in defs:
+                    row = bench_def(def_file, cube_dir, cards, args)
+                    row['scale'] = scale
+                    results['results'].append(row)
+                    times = ' '.join('{} {:.2f}'.format(key, row[key]) for key in timings)
+                    print('{:<32} x{:<4} {}'.format(row['def'], scale, times), file=sys.stderr)
+            finally:
+                os.chdir(cwd)
+
+    if args.out is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.out, 'w') as out:
+            json.dump(results, out, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as inp:
+            compare(json.load(inp), results)
+
+
+if __name__ == '__main__':
+    main()
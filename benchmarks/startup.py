@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Time how long short invocations take to start, each step in a fresh interpreter.
+
+Run from anywhere with `./benchmarks/startup.py [--runs N] [--json]`. Times are medians in
+milliseconds with the bare interpreter startup subtracted.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+steps = [
+    ('import parsertree', 'import parsertree'),
+    ('create_tree', "import parsertree; parsertree.create_tree('standardpack.def')"),
+    ('first pack', "import parsertree; parsertree.create_tree('standardpack.def').eval([])"),
+]
+
+
+def time_code(code, runs):
+    env = dict(os.environ, PYTHONPATH=root)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=root, env=env, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('--runs', type=int, default=10)
+    arg_parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = arg_parser.parse_args()
+
+    # Warm the bytecode caches and parse tables so every run measures the same thing
+    time_code(steps[-1][1], 1)
+    interpreter = time_code('pass', args.runs)
+    results = {name: time_code(code, args.runs) - interpreter for name, code in steps}
+    if args.json:
+        print(json.dumps({'interpreter_ms': interpreter, 'steps_ms': results}))
+    else:
+        print('{:<20}{:>10.1f} ms'.format('interpreter', interpreter))
+        for name, elapsed in results.items():
+            print('{:<20}{:>10.1f} ms'.format(name, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+The table of every card in a cube, so evaluation can work on integer card ids.
+
+A table can also be written to a binary card database, which any number of processes can map read
+only and share instead of each holding its own copy. The file starts with a header, followed by a
+fixed width record for every card, a record for every rarity file with the range of its cards in
+the member list, the member list of card ids, a color bitmask per card and a heap of UTF-8 strings.
+"""
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import uuid
+
+from array import array
+
+from gatherer import card_mvid, get_color_identity, split_and_cut
+
+color_bits = {'White': 1, 'Blue': 2, 'Black': 4, 'Red': 8, 'Green': 16}
+# The color identity of every bitmask, shared by all the cards with it
+mask_colors = [frozenset(color for color, bit in color_bits.items() if mask & bit)
+               for mask in range(32)]
+# The colors of every bitmask in WUBRG order, which GetColors hands out as a fresh list
+mask_color_order = [tuple(color for color, bit in color_bits.items() if mask & bit)
+                    for mask in range(32)]
+
+db_magic = b'CUBECARD'
+db_version = 2
+# Magic, version, token, counts of cards, files and members, offsets of the records, file records,
+# members, color masks and heap
+db_header = struct.Struct('<8sI16sIII5Q')
+# mvid, offset and length of the .dec lines and of the name in the heap, index of the first file
+card_record = struct.Struct('<qIIIII4x')
+# Offset and length of the name in the heap, first member and number of members
+file_record = struct.Struct('<IIII')
+
+
+def card_colors(cd):
+    """
+    The colors in a cards identity as a frozenset, ignoring Colorless.
+    """
+    return frozenset(get_color_identity(cd)) - {'Colorless'}
+
+
+def colors_mask(card_colors):
+    res = 0
+    for color in card_colors:
+        res |= color_bits.get(color, 0)
+    return res
+
+
+class CardTable():
+    """
+    Every card loaded from the rarity directories, identified by its row number.
+
+    Columns are parallel arrays indexed by card id: the two lines of the card in its .dec file, its
+    mvid, its name, the rarity file it was first read from and its color identity as a bitmask.
+    Remaining copies are per run and kept by each Availability.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.lines = []
+        self.mvids = array('l')
+        self.names = []
+        self.files = []
+        self.color_masks = array('B')
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add(self, card_lines, fname):
+        """
+        Get the id of a card, adding it to the table the first time it is seen.
+        """
+        cd = self.ids.get(card_lines)
+        if cd is None:
+            cd = self.ids[card_lines] = len(self.lines)
+            self.lines.append(card_lines)
+            self.mvids.append(int(card_mvid(card_lines)))
+            self.names.append(split_and_cut(card_lines, '\n', 1, ' ', (1, None)))
+            self.files.append(sys.intern(fname))
+        return cd
+
+    def index_colors(self):
+        """
+        Look up the colors of every card once so filters do not go through the color cache.
+        """
+        self.color_masks = array('B', (colors_mask(card_colors(card_lines))
+                                       for card_lines in self.lines))
+
+    def dec_lines(self, pack):
+        """
+        Turn a pack of card ids back into the lines of a .dec file.
+        """
+        return [self.lines[cd] for cd in pack]
+
+
+def aligned(offset):
+    return (offset + 7) & ~7
+
+
+def write_database(cards, files, path):
+    """
+    Write a card table to a card database at path and open it.
+
+    files are (name, card ids) pairs for every rarity file, the name being the rarity and file name
+    joined by a slash as in the files column, and for every rarity under its name alone. The
+    database is replaced atomically, so processes that have the old one mapped keep reading it
+    unchanged.
+    """
+    heap = bytearray()
+
+    def store(text):
+        data = text.encode()
+        heap.extend(data)
+        return len(heap) - len(data), len(data)
+
+    files = list(files)
+    file_index = {}
+    file_records = bytearray()
+    members = array('I')
+    for i, (name, ids) in enumerate(files):
+        file_index.setdefault(name, i)
+        file_records += file_record.pack(*store(name), len(members), len(ids))
+        members.extend(ids)
+    records = bytearray()
+    for cd in range(len(cards)):
+        records += card_record.pack(cards.mvids[cd], *store(cards.lines[cd]),
+                                    *store(cards.names[cd]), file_index[cards.files[cd]])
+
+    token = uuid.uuid4().bytes
+    sections = [records, file_records, members.tobytes(), bytes(cards.color_masks), heap]
+    offsets = []
+    offset = db_header.size
+    for section in sections:
+        offset = aligned(offset)
+        offsets.append(offset)
+        offset += len(section)
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(db_header.pack(db_magic, db_version, token, len(cards), len(files),
+                                     len(members), *offsets))
+            for offset, section in zip(offsets, sections):
+                out.write(bytes(offset - out.tell()))
+                out.write(section)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return CardDatabase(path, token)
+
+
+class RecordColumn():
+    """
+    One field of every card in a CardDatabase, read from the mapping when it is indexed.
+    """
+    def __init__(self, db, read):
+        self.db = db
+        self.read = read
+
+    def __len__(self):
+        return len(self.db)
+
+    def __getitem__(self, cd):
+        if cd < 0:
+            cd += len(self.db)
+        if not 0 <= cd < len(self.db):
+            raise IndexError(cd)
+        return self.read(cd)
+
+    def __iter__(self):
+        return map(self.read, range(len(self.db)))
+
+
+class CardDatabase():
+    """
+    A card table read from a file written by write_database, mapped read only so every process
+    using it shares the same pages.
+
+    Has the columns of CardTable, decoding strings from the heap as they are read, and the cards of
+    every rarity and rarity file, which card pools index into directly. Pickling keeps only the
+    path and the token of the file, so a worker process maps the same file instead of receiving a
+    copy, and fails with ValueError if it was rewritten.
+    """
+    def __init__(self, path, token=None):
+        self.path = os.path.abspath(path)
+        self.map_file(token)
+
+    def map_file(self, token):
+        with open(self.path, 'rb') as inp:
+            self.map = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < db_header.size:
+            raise ValueError('{} is not a card database'.format(self.path))
+        (magic, version, self.token, count, file_count, member_count, records, files, members,
+         masks, heap) = db_header.unpack_from(self.map)
+        if magic != db_magic or version != db_version:
+            raise ValueError('{} is not a card database of version {}'.format(self.path,
+                                                                               db_version))
+        if token is not None and token != self.token:
+            raise ValueError('{} has been rewritten'.format(self.path))
+        self.count = count
+        self.records = records
+        self.heap = heap
+        view = memoryview(self.map)
+        self.members = view[members:members + 4 * member_count].cast('I')
+        self.color_masks = view[masks:masks + count]
+        self.file_entries = []
+        for i in range(file_count):
+            name_at, name_len, start, length = file_record.unpack_from(
+                self.map, files + i * file_record.size)
+            self.file_entries.append((self.string(name_at, name_len), start, length))
+        self.lines = RecordColumn(self, self.card_line)
+        self.names = RecordColumn(self, self.card_name)
+        self.mvids = RecordColumn(self, lambda cd: self.record(cd)[0])
+        self.files = RecordColumn(self, lambda cd: self.file_entries[self.record(cd)[5]][0])
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        return {'path': self.path, 'token': self.token}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.map_file(state['token'])
+
+    def string(self, at, length):
+        at += self.heap
+        return str(self.map[at:at + length], 'utf-8')
+
+    def record(self, cd):
+        return card_record.unpack_from(self.map, self.records + cd * card_record.size)
+
+    def card_line(self, cd):
+        _, at, length, _, _, _ = self.record(cd)
+        return self.string(at, length)
+
+    def card_name(self, cd):
+        _, _, _, at, length, _ = self.record(cd)
+        return self.string(at, length)
+
+    def rarity_cards(self, rarity):
+        """
+        The ids of every card of a rarity in the order they were read, a view of the mapping.
+        """
+        for name, start, length in self.file_entries:
+            if name == rarity:
+                return self.members[start:start + length]
+        return self.members[0:0]
+
+    def rarity_files(self, rarity):
+        """
+        The name and card ids of every file of a rarity, the ids a view of the mapping.
+        """
+        prefix = rarity + '/'
+        return [(name[len(prefix):], self.members[start:start + length])
+                for name, start, length in self.file_entries if name.startswith(prefix)]
+
+    def dec_lines(self, pack):
+        return [self.card_line(cd) for cd in pack]
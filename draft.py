@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Simulate draft pods: every player opens a pack a round, picks a card and passes the rest on.
+
+Packs come from the same tree as sealed pools, each pod from a full cube, and are kept as arrays of
+card ids while bots pick from them, so nothing is read or written per pick. Picks are made by bots,
+chosen per seat from the strategies below: add a Bot subclass to strategies to try another one.
+Statistics are running counters, so any number of pods can be simulated.
+"""
+import argparse
+import csv
+import json
+import random
+import sys
+
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from cardtable import color_bits
+from parsertree import Context, DefError, compile_tree, create_tree
+
+bit_colors = list(color_bits)
+# The color bits set in every mask, so scoring a card does not test each color
+mask_bits = [[bit for bit in range(len(bit_colors)) if mask >> bit & 1]
+             for mask in range(1 << len(bit_colors))]
+
+
+class Bot():
+    """
+    Picks a card from each pack passed to it. Every seat of every pod gets a new bot.
+    """
+    def __init__(self, cards, rng, ratings):
+        self.cards = cards
+        self.rng = rng
+        self.ratings = ratings
+
+    def pick(self, pack, pool):
+        """
+        The index in pack of the card to take, given the cards already in pool.
+        """
+        raise NotImplementedError
+
+    def best(self, pack, score):
+        """
+        The index of the card with the highest score, a random one of them on a tie.
+        """
+        scores = [score(cd) for cd in pack]
+        top = max(scores)
+        ties = [i for i, s in enumerate(scores) if s == top]
+        return ties[0] if len(ties) == 1 else self.rng.choice(ties)
+
+
+class RandomBot(Bot):
+    def pick(self, pack, pool):
+        return self.rng.randrange(len(pack))
+
+
+class RatingBot(Bot):
+    """
+    Takes the highest rated card, whatever its colors.
+    """
+    def pick(self, pack, pool):
+        return self.best(pack, self.ratings.__getitem__)
+
+
+class ColorBot(Bot):
+    """
+    Takes the best card for its colors, the two it has picked most once it has made commit_after
+    picks.
+
+    Before committing it goes by rating, then by how many cards of the same colors it already has.
+    Once committed, cards outside its colors are only taken when nothing else is left. Colors come
+    from the same bitmasks GetColors filters are vectorized with.
+    """
+    commit_after = 4
+
+    def __init__(self, cards, rng, ratings):
+        super().__init__(cards, rng, ratings)
+        self.counts = [0] * len(bit_colors)
+
+    def pick(self, pack, pool):
+        masks = self.cards.color_masks
+        counts = self.counts
+        ratings = self.ratings
+        allowed = main_colors(counts) if len(pool) >= self.commit_after else 31
+
+        def score(cd):
+            mask = masks[cd]
+            return mask & ~allowed == 0, ratings[cd], sum([counts[bit] for bit in mask_bits[mask]])
+        res = self.best(pack, score)
+        for bit in mask_bits[masks[pack[res]]]:
+            counts[bit] += 1
+        return res
+
+
+strategies = {
+    'random': RandomBot,
+    'ratings': RatingBot,
+    'colors': ColorBot,
+}
+
+
+def main_colors(counts):
+    """
+    The bitmask of the two colors with the most cards, or fewer if fewer colors have any.
+    """
+    order = sorted(range(len(counts)), key=lambda bit: -counts[bit])
+    return sum(1 << bit for bit in order[:2] if counts[bit])
+
+
+def load_ratings(path, cards):
+    """
+    Read a rating per card name, higher is better, from a JSON object or name,rating CSV lines.
+
+    Returns an array of ratings by card id, 0 for cards the file does not rate.
+    """
+    with open(path, newline='') as inp:
+        if path.endswith('.json'):
+            by_name = json.load(inp)
+        else:
+            by_name = {row[0]: row[1] for row in csv.reader(inp)
+                       if len(row) >= 2 and not row[0].startswith('#')}
+    res = array('d', [0.0]) * len(cards)
+    for cd, name in enumerate(cards.names):
+        rating = by_name.get(name)
+        if rating is not None:
+            try:
+                res[cd] = float(rating)
+            except ValueError:
+                raise ValueError('{}: rating {!r} of {} is not a number'.format(path, rating, name))
+    return res
+
+
+def open_pod(compiled, ctx, players, rounds):
+    """
+    Build the packs of one pod, players packs for each round, as arrays of card ids.
+    """
+    packs = []
+    for _ in range(players * rounds):
+        pack = []
+        compiled.eval(pack, ctx)
+        packs.append(array('l', pack))
+    return packs
+
+
+def draft(packs, players, bots, stats=None):
+    """
+    Draft packs, where packs[round * players + seat] is opened by seat, with one bot per seat.
+
+    Packs are passed left in odd rounds and right in even ones until every card is picked. Returns
+    each seat's picks in order. The packs are emptied.
+    """
+    pools = [array('l') for _ in range(players)]
+    for first in range(0, len(packs), players):
+        passing = packs[first:first + players]
+        # Rotating the list by one moves every pack to the next seat
+        step = 1 if first // players % 2 == 0 else -1
+        pick = 0
+        while any(passing):
+            pick += 1
+            for seat, pack in enumerate(passing):
+                if pack:
+                    cd = pack.pop(bots[seat].pick(pack, pools[seat]))
+                    pools[seat].append(cd)
+                    if stats is not None:
+                        stats.add_pick(cd, pick)
+            passing = passing[-step:] + passing[:-step]
+    return pools
+
+
+def make_bots(cards, seats, rng, ratings=None):
+    """
+    A bot for every seat with the strategy named for it, all drawing from rng.
+    """
+    if ratings is None:
+        ratings = array('d', [0.0]) * len(cards)
+    return [strategies[name](cards, rng, ratings) for name in seats]
+
+
+def seat_strategies(names, players):
+    """
+    The strategy of every seat from a comma separated list, repeated to fill the pod.
+    """
+    names = names.split(',')
+    for name in names:
+        if name not in strategies:
+            raise ValueError('Unknown strategy {}, choose from {}'.format(name,
+                                                                          ', '.join(strategies)))
+    return [names[seat % len(names)] for seat in range(players)]
+
+
+class DraftStats():
+    """
+    Running statistics over every pod of a simulation.
+
+    For cards, how often each was picked and how early. For each strategy, the colors its pools
+    ended up in and how much of a pool was within its two main colors.
+    """
+    def __init__(self, cards):
+        self.cards = cards
+        self.pods = 0
+        self.failed_pods = 0
+        self.taken = array('l', [0]) * len(cards)
+        self.pick_sums = array('l', [0]) * len(cards)
+        self.first_picks = array('l', [0]) * len(cards)
+        self.pools = Counter()
+        self.on_color = Counter()
+        self.pairs = {}
+
+    def add_pick(self, cd, pick):
+        self.taken[cd] += 1
+        self.pick_sums[cd] += pick
+        if pick == 1:
+            self.first_picks[cd] += 1
+
+    def add_pool(self, strategy, pool):
+        masks = self.cards.color_masks
+        counts = [0] * len(bit_colors)
+        colored = 0
+        for cd in pool:
+            mask = masks[cd]
+            if mask:
+                colored += 1
+                for bit in mask_bits[mask]:
+                    counts[bit] += 1
+        main = main_colors(counts)
+        self.pools[strategy] += 1
+        on_color = sum(masks[cd] & ~main == 0 for cd in pool if masks[cd])
+        self.on_color[strategy] += on_color / colored if colored else 1
+        pair = '/'.join(bit_colors[bit] for bit in mask_bits[main]) or 'Colorless'
+        self.pairs.setdefault(strategy, Counter())[pair] += 1
+
+    def merge(self, other):
+        self.pods += other.pods
+        self.failed_pods += other.failed_pods
+        for mine, theirs in ((self.taken, other.taken), (self.pick_sums, other.pick_sums),
+                             (self.first_picks, other.first_picks)):
+            for cd, value in enumerate(theirs):
+                mine[cd] += value
+        self.pools.update(other.pools)
+        self.on_color.update(other.on_color)
+        for strategy, pairs in other.pairs.items():
+            self.pairs.setdefault(strategy, Counter()).update(pairs)
+
+    def mean_pick(self, cd):
+        return self.pick_sums[cd] / self.taken[cd] if self.taken[cd] else None
+
+    def extreme_cards(self, n=10):
+        order = sorted((cd for cd in range(len(self.cards)) if self.taken[cd]),
+                       key=lambda cd: (self.mean_pick(cd), self.cards.names[cd]))
+        entry = lambda cd: {'name': self.cards.names[cd], 'taken': self.taken[cd],
+                            'mean_pick': self.mean_pick(cd), 'first_picks': self.first_picks[cd]}
+        return {'earliest': [entry(cd) for cd in order[:n]],
+                'latest': [entry(cd) for cd in order[::-1][:n]]}
+
+    def strategy_summary(self):
+        return {strategy: {'pools': pools, 'on_color': self.on_color[strategy] / pools,
+                           'pairs': dict(self.pairs[strategy].most_common())}
+                for strategy, pools in sorted(self.pools.items())}
+
+    def to_json(self):
+        return {
+            'pods': self.pods,
+            'failed_pods': self.failed_pods,
+            'strategies': self.strategy_summary(),
+            'extreme_cards': self.extreme_cards(),
+        }
+
+    def report(self, out=sys.stdout):
+        out.write('{} pods, {} failed\n\n'.format(self.pods, self.failed_pods))
+        for strategy, summary in self.strategy_summary().items():
+            out.write('{}: {} pools, {:.1f}% of colored picks in the two main colors\n'.format(
+                strategy, summary['pools'], 100 * summary['on_color']))
+            pairs = ', '.join('{} {}'.format(pair, n) for pair, n in summary['pairs'].items())
+            out.write('  ' + pairs + '\n')
+        for title, key in (('Picked earliest', 'earliest'), ('Picked latest', 'latest')):
+            out.write('\n{}\n'.format(title))
+            for entry in self.extreme_cards()[key]:
+                out.write('  {mean_pick:5.2f} {name} ({taken} taken, {first_picks} first picks)\n'
+                          .format(**entry))
+
+
+def simulate_part(tree, pods, players, rounds, seats, ratings, seed):
+    """
+    Draft the pods in the range pods, each with its own random streams for packs and bots.
+    """
+    compiled = compile_tree(tree)
+    stats = DraftStats(tree.cards)
+    for pod in pods:
+        ctx = Context('{}:{}'.format(seed, pod))
+        stats.pods += 1
+        try:
+            packs = open_pod(compiled, ctx, players, rounds)
+        except ValueError:
+            stats.failed_pods += 1
+            continue
+        bots = make_bots(tree.cards, seats, random.Random('{}:{}:bots'.format(seed, pod)), ratings)
+        for seat, pool in enumerate(draft(packs, players, bots, stats)):
+            stats.add_pool(seats[seat], pool)
+    return stats
+
+
+def simulate(tree, pods, players=8, rounds=3, seats=None, ratings=None, seed=None, workers=1):
+    """
+    Draft pods pods of players seats and rounds packs each, split across worker processes.
+
+    A pod whose packs cannot all be built is counted as failed. The same seed drafts the same pods
+    whatever the number of workers.
+    """
+    if seats is None:
+        seats = ['colors'] * players
+    if seed is None:
+        seed = random.getrandbits(64)
+    parts = [range(part, pods, workers) for part in range(workers)]
+    if workers == 1:
+        return simulate_part(tree, parts[0], players, rounds, seats, ratings, seed)
+    stats = DraftStats(tree.cards)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(simulate_part, tree, part, players, rounds, seats, ratings, seed)
+                   for part in parts]
+        for future in futures:
+            stats.merge(future.result())
+    return stats
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('def_file')
+    arg_parser.add_argument('pods', type=int, help='Number of pods to draft')
+    arg_parser.add_argument('--players', type=int, default=8)
+    arg_parser.add_argument('--rounds', type=int, default=3, help='Packs opened by each player')
+    arg_parser.add_argument('--bots', default='colors',
+                            help='Comma separated strategies for the seats, from {}'.format(
+                                ', '.join(strategies)))
+    arg_parser.add_argument('--ratings', default=None, help='JSON or CSV file rating cards by name')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Processes to draft with')
+    arg_parser.add_argument('--seed', default=None, help='Seed to make the simulation reproducible')
+    arg_parser.add_argument('--json', action='store_true', help='Print the statistics as JSON')
+    args = arg_parser.parse_args()
+
+    try:
+        seats = seat_strategies(args.bots, args.players)
+        tree = create_tree(args.def_file)
+        ratings = None if args.ratings is None else load_ratings(args.ratings, tree.cards)
+    except (DefError, ValueError, OSError) as e:
+        sys.exit(str(e))
+    stats = simulate(tree, args.pods, args.players, args.rounds, seats, ratings, args.seed,
+                     args.workers)
+    if args.json:
+        json.dump(stats.to_json(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        stats.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-import pickle
+import atexit
 import os
-import urllib.request
-
-from bs4 import BeautifulSoup
+import pickle
+import threading
+import time
+import urllib.parse
 # Future Work. Support looking up without mvid number, Fix split cards, CMC extraction, Type Extraction
 
 
@@ -34,40 +35,332 @@ def split_and_cut(s, txt, ind, *args):
 colors = ['White', 'Blue', 'Black', 'Red', 'Green', 'Colorless']
 
 
-def disk_cache(cache_file):
-    def dec(fun):
-        cache = {}
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as inp:
-                cache = pickle.load(inp)
+class ColorStore():
+    """
+    Append only on disk store of card color identities keyed by multiverse id.
+
+    Every line of the file is `mvid<TAB>Color,Color,...`. New entries are buffered and appended in
+    batches of batch_size (and at exit) with a single O_APPEND write, so readers in other processes
+    never see a rewritten file. A partial or malformed line left by a crash is skipped when reading.
+    Older pickle caches keyed by the card lines are converted on first load.
+    """
+    def __init__(self, path, batch_size=25):
+        self.path = path
+        self.batch_size = batch_size
+        self.entries = None
+        self.offset = 0
+        # Device, inode, size and mtime of the file when it was last read
+        self.seen = None
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """
+        Read any complete lines appended since the last load, or the whole file again if it was
+        compacted or edited since.
+        """
+        if self.entries is None:
+            self.entries = {}
+            self.offset = 0
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        rewritten = self.seen is not None and (
+            (stat.st_dev, stat.st_ino) != self.seen[:2] or stat.st_size < self.offset or
+            (stat.st_size == self.seen[2] and stat.st_mtime_ns != self.seen[3]))
+        if rewritten:
+            self.entries = {}
+            self.offset = 0
+        self.seen = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with open(self.path, 'rb') as inp:
+            if self.offset == 0 and inp.read(1) == b'\x80':
+                inp.seek(0)
+                self.migrate(pickle.load(inp))
+                return
+            inp.seek(self.offset)
+            data = inp.read()
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        self.read_lines(data[:end].decode('utf-8', 'replace'))
+        if rewritten:
+            # Entries not written yet are newer than anything in the file
+            self.read_lines(''.join(self.pending))
+
+    def read_lines(self, text):
+        for line in text.splitlines():
+            fields = line.split('\t')
+            if len(fields) != 2 or not fields[0].isdigit():
+                continue
+            card_colors = frozenset(c for c in fields[1].split(',') if c)
+            if card_colors <= set(colors):
+                self.entries[fields[0]] = card_colors
+
+    def migrate(self, cache):
+        """
+        Convert a legacy pickle cache keyed by card lines to the journal format.
+        """
+        for args, card_colors in cache.items():
+            self.entries[card_mvid(args[0])] = frozenset(card_colors)
+        self.compact()
+
+    def get(self, mvid):
+        if self.entries is None:
+            self.load()
+        res = self.entries.get(mvid)
+        if res is None:
+            # Another process may have resolved it since we last looked
+            self.load()
+            res = self.entries.get(mvid)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    def put(self, mvid, card_colors):
+        if self.entries is None:
+            self.load()
+        card_colors = frozenset(card_colors)
+        self.entries[mvid] = card_colors
+        self.pending.append(self.format_line(mvid, card_colors))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    @staticmethod
+    def format_line(mvid, card_colors):
+        return '{}\t{}\n'.format(mvid, ','.join(c for c in colors if c in card_colors))
+
+    def flush(self):
+        """
+        Append all buffered entries to the file in one write.
+        """
+        if len(self.pending) == 0:
+            return
+        data = ''.join(self.pending).encode('utf-8')
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+                # Terminate a partial line left by an interrupted writer
+                data = b'\n' + data
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        self.pending = []
 
-        def f(*args):
-            res = cache.get(tuple(args), None)
-            if res is not None:
-                return res
-            res = fun(*args)
-            cache[tuple(args)] = res
-            with open(cache_file, 'wb') as inp:
-                pickle.dump(cache, inp)
-            return res
-        return f
-    return dec
+    def update(self, new_entries):
+        """
+        Add many entries at once, rewriting the file a single time.
+        """
+        if self.entries is None:
+            self.load()
+        for mvid, card_colors in new_entries.items():
+            self.entries[mvid] = frozenset(card_colors)
+        self.compact()
+
+    def compact(self):
+        """
+        Rewrite the file with one line per card, atomically replacing the old one.
+        """
+        if self.entries is None:
+            self.load()
+        self.pending = []
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as out:
+            for mvid in sorted(self.entries, key=int):
+                out.write(self.format_line(mvid, self.entries[mvid]))
+        os.replace(tmp_path, self.path)
+        stat = os.stat(self.path)
+        self.offset = stat.st_size
+        self.seen = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def card_mvid(card_lines):
+    """
+    Pull the multiverse id out of the two lines for a card in a dec file.
+    """
+    return split_and_cut(card_lines, 'mvid:', 1, ' ', 0)
+
+
+color_store = ColorStore('color.cache')
+atexit.register(color_store.flush)
 
 
-@disk_cache('color.cache')
 def get_color_identity(card_lines):
     """
     Get a set of colors in the cards color identity. Card passed as two lines from a dec file.
     """
-    res = set()
+    mvid = card_mvid(card_lines)
+    res = color_store.get(mvid)
+    if res is None:
+        res = fetch_color_identity(mvid)
+        color_store.put(mvid, res)
+    return res
+
+
+class GathererFetcher():
+    """
+    Fetch card details pages over keep-alive connections from a bounded pool of threads.
+
+    The networking modules are only imported once something has to be fetched.
+
+    Each thread keeps its own connection to base_url. Requests are spaced at least min_interval
+    seconds apart across all threads, and connection errors, 429 and 5xx responses are retried up
+    to retries times with exponential backoff. Redirects are followed, each one using up a try.
+    """
+    details_path = '/Pages/Card/Details.aspx?multiverseid={}'
+    redirect_statuses = (301, 302, 307, 308)
 
-    mvid = split_and_cut(card_lines, 'mvid:', 1, ' ', 0)
-    r_url = 'http://gatherer.wizards.com/Pages/Card/Details.aspx?multiverseid={}'.format(mvid)
-    doc = None
-    req = urllib.request.urlopen(r_url)
-    doc = BeautifulSoup(req.read(), "lxml")
-    req.close()
+    def __init__(self, base_url='http://gatherer.wizards.com', workers=8, retries=3, backoff=0.5,
+                 min_interval=0.05, timeout=30):
+        url = urllib.parse.urlsplit(base_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.local = threading.local()
+        self.rate_lock = threading.Lock()
+        self.next_request = 0
 
+    def connection(self, scheme, netloc):
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            import http.client
+            if scheme == 'https':
+                conn_class = http.client.HTTPSConnection
+            else:
+                conn_class = http.client.HTTPConnection
+            conn = conns[scheme, netloc] = conn_class(netloc, timeout=self.timeout)
+        return conn
+
+    def close_connection(self, scheme, netloc):
+        conn = getattr(self.local, 'conns', {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def wait_turn(self):
+        with self.rate_lock:
+            now = time.monotonic()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def fetch_page(self, mvid):
+        import http.client
+
+        scheme = self.scheme
+        netloc = self.netloc
+        path = self.prefix + self.details_path.format(mvid)
+        redirected = False
+        for attempt in range(self.retries + 1):
+            if attempt > 0 and not redirected:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            redirected = False
+            self.wait_turn()
+            try:
+                conn = self.connection(scheme, netloc)
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (OSError, http.client.HTTPException):
+                self.close_connection(scheme, netloc)
+                if attempt == self.retries:
+                    raise
+                continue
+            if resp.status == 200:
+                return body
+            location = resp.getheader('Location')
+            if resp.status in self.redirect_statuses and location:
+                base = '{}://{}{}'.format(scheme, netloc, path)
+                url = urllib.parse.urlsplit(urllib.parse.urljoin(base, location))
+                scheme = url.scheme
+                netloc = url.netloc
+                path = url.path + ('?' + url.query if url.query else '')
+                redirected = True
+                continue
+            if resp.status != 429 and resp.status < 500:
+                break
+        raise IOError('Failed to fetch {} from {}: HTTP {}'.format(path, netloc, resp.status))
+
+    def fetch(self, mvid):
+        return parse_color_identity(self.fetch_page(mvid))
+
+    def fetch_all(self, mvids):
+        """
+        Resolve the color identities of many cards concurrently.
+
+        Returns a dict of the colors found and a dict of the errors for mvids that failed.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        res = {}
+        errors = {}
+
+        def fetch_one(mvid):
+            try:
+                res[mvid] = self.fetch(mvid)
+            except Exception as e:
+                errors[mvid] = e
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(fetch_one, mvids))
+        return res, errors
+
+
+fetcher = GathererFetcher()
+
+
+def fetch_color_identity(mvid):
+    """
+    Look up the colors in a cards identity on Gatherer.
+    """
+    return fetcher.fetch(mvid)
+
+
+def prefetch_color_identities(cards, card_fetcher=None):
+    """
+    Resolve every card not in the color cache before evaluation starts.
+
+    Raises IOError naming the cards whose colors could not be fetched.
+    """
+    card_fetcher = card_fetcher or fetcher
+    # Pick up colors changed by another process since the cache was read
+    color_store.load()
+    missing = sorted({card_mvid(cd) for cd in cards if color_store.get(card_mvid(cd)) is None})
+    if len(missing) == 0:
+        return
+    res, errors = card_fetcher.fetch_all(missing)
+    for mvid, card_colors in res.items():
+        color_store.put(mvid, card_colors)
+    color_store.flush()
+    if len(errors) > 0:
+        failed = sorted(errors)
+        shown = ', '.join(failed[:10]) + (', ...' if len(failed) > 10 else '')
+        raise IOError('Could not resolve colors for {} cards, mvids {}: {}. Import them from local '
+                      'card data with ./update.py import-colors <source>'.format(
+                          len(failed), shown, next(iter(errors.values()))))
+
+
+def parse_color_identity(page):
+    """
+    Get the set of colors in the mana symbols of a Gatherer card details page.
+    """
+    # Only pulled in when a page actually has to be parsed, as it is slow to import
+    from bs4 import BeautifulSoup
+
+    res = set()
+    doc = BeautifulSoup(page, "lxml")
     search_items = doc.find_all(**{'class': 'manaRow'})
     search_items += doc.find_all(**{'class': 'cardtextbox'})
     for item in search_items:
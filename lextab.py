@@ -0,0 +1,10 @@
+# lextab.py. This file automatically created by PLY (version 3.11). Don't edit!
+_tabversion   = '3.10'
+_lextokens    = set(('ADD', 'AND', 'ANY', 'ASSIGN', 'BOUND', 'COMMA', 'EXTRACT', 'FROM', 'FUNCTION', 'ID', 'INTEGER', 'LBRACE', 'LBRACKET', 'LPAREN', 'NOT', 'OR', 'PROPOSITION', 'QUOTA', 'RARITY_NAME', 'RBRACE', 'RBRACKET', 'REPEAT', 'RPAREN', 'SPLIT', 'STRING', 'WHERE'))
+_lexreflags   = 64
+_lexliterals  = ''
+_lexstateinfo = {'INITIAL': 'inclusive'}
+_lexstatere   = {'INITIAL': [('(?P<t_RARITY_NAME>[a-zA-Z]+:)|(?P<t_STRING>(\'[^\']*\')|("[^"]*"))|(?P<t_INTEGER>[0-9]+)|(?P<t_ID>[a-zA-Z_][a-zA-Z0-9_]*)|(?P<t_newline>\\n+)|(?P<t_ignore_COMMENT>/\\*.*\\*/)|(?P<t_EXTRACT>->)|(?P<t_SPLIT>/>)|(?P<t_LBRACKET>\\[)|(?P<t_RBRACKET>\\])|(?P<t_LPAREN>\\()|(?P<t_RPAREN>\\))|(?P<t_ASSIGN>=)|(?P<t_LBRACE>{)|(?P<t_RBRACE>})|(?P<t_COMMA>,)', [None, ('t_RARITY_NAME', 'RARITY_NAME'), ('t_STRING', 'STRING'), None, None, ('t_INTEGER', 'INTEGER'), ('t_ID', 'ID'), ('t_newline', 'newline'), (None, None), (None, 'EXTRACT'), (None, 'SPLIT'), (None, 'LBRACKET'), (None, 'RBRACKET'), (None, 'LPAREN'), (None, 'RPAREN'), (None, 'ASSIGN'), (None, 'LBRACE'), (None, 'RBRACE'), (None, 'COMMA')])]}
+_lexstateignore = {'INITIAL': ' \t'}
+_lexstateerrorf = {'INITIAL': 't_error'}
+_lexstateeoff = {}
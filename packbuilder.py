@@ -1,55 +1,250 @@
 #!/usr/bin/env python3
+import argparse
+import json
 import os
 import random
-import shutil
 import sys
 
-from parsertree import create_tree
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from draft import draft, load_ratings, make_bots, seat_strategies, strategies
+from gatherer import card_mvid, split_and_cut
+from parsertree import Context, DefError, StatementError, compile_tree, create_tree, tree_cache
+from profiler import Profiler
+from resultwriter import archive_kinds, open_results
 
 DEBUG = False
 
-tree = create_tree(sys.argv[1])
-# print(tree)
-
-players = int(sys.argv[2])
-packs_per_player = int(sys.argv[3])
-dest_dir = 'results'
-if len(sys.argv) == 5:
-    dest_dir = sys.argv[4]
-
-if os.path.exists('{}'.format(dest_dir)):
-    if os.path.exists('{}.bak'.format(dest_dir)):
-        print('Deleting {}.bak'.format(dest_dir))
-        shutil.rmtree('{}.bak'.format(dest_dir))
-    print('Moving {0:} to {0:}.bak'.format(dest_dir))
-    shutil.move('{}'.format(dest_dir), '{}.bak'.format(dest_dir))
-
-packs = []
-for _ in range(players * packs_per_player):
-    pack = []
-    tree.eval(pack)
-    if DEBUG:
-        print(pack)
-    packs.append(pack)
-
-
-random.shuffle(packs)
-players_with_packs = []
-for i in range(players):
-    player_packs = []
-    for j in range(packs_per_player):
-        player_packs.append(packs.pop())
-    players_with_packs.append(player_packs)
-
-for player_id, player_packs in enumerate(players_with_packs):
-    player_pool = []
-    directory = '{}/player-{}'.format(dest_dir, player_id + 1)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    for pack_id, player_pack in enumerate(player_packs):
-        player_pool += player_pack
-        with open('{}/pack-{}.dec'.format(directory, pack_id + 1), 'w') as pack_file:
-            pack_file.write(''.join(player_pack))
-
-    with open('{}/pool.dec'.format(directory), 'w') as pool_file:
-        pool_file.write(''.join(player_pool))
+
+def part_context(seed, part):
+    """
+    The Context for one part of a run, so a seed gives the same packs however they are written.
+    """
+    return Context(None if seed is None else '{}:{}'.format(seed, part))
+
+
+def generate_part(tree, seed, part, counts, profiler=None):
+    """
+    Generate counts[part] packs of card ids from that part of the card copies with its own random
+    stream.
+    """
+    ctx = part_context(seed, part)
+    if len(counts) > 1:
+        for rarity in tree.lst:
+            ctx.availability(rarity).split_copies(part, counts)
+    tree = compile_tree(tree, profiler)
+    packs = []
+    for _ in range(counts[part]):
+        pack = []
+        tree.eval(pack, ctx)
+        if DEBUG:
+            print(pack)
+        packs.append(pack)
+    return packs
+
+
+def generate(tree, count, seed, workers=1, profiler=None):
+    """
+    Generate count packs split across worker processes.
+
+    Every worker gets its share of the packs and the same share of the copies of each rarity, so
+    the duplication limits hold across all packs and the same seed and number of workers give the
+    same packs. A profiler can only time packs generated in this process.
+    """
+    counts = [count // workers + (part < count % workers) for part in range(workers)]
+    if workers == 1:
+        return generate_part(tree, seed, 0, counts, profiler)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(generate_part, tree, seed, part, counts) for part in range(workers)]
+        return [pack for future in futures for pack in future.result()]
+
+
+def generate_packs(def_file, n, seed=None, profiler=None):
+    """
+    Lazily generate n packs, yielding each as the .dec lines of its cards as soon as it is built.
+
+    def_file can be a path or a tree from create_tree. Only the current pack is held in memory.
+    """
+    tree = create_tree(def_file) if isinstance(def_file, str) else def_file
+    tree = compile_tree(tree, profiler)
+    ctx = part_context(seed, 0)
+    for _ in range(n):
+        pack = []
+        tree.eval(pack, ctx)
+        yield tree.cards.dec_lines(pack)
+
+
+def write_dec_stream(packs, dest, players):
+    """
+    Write packs to .dec files as they are produced, dealing them to players round robin.
+
+    Each pack is also appended to the player's pool.dec, so nothing is kept between packs. dest is
+    a directory or a writer from resultwriter.open_results.
+    """
+    if isinstance(dest, str):
+        with open_results(dest) as out:
+            write_dec_stream(packs, out, players)
+        return
+    for i, pack in enumerate(packs):
+        directory = 'player-{}'.format(i % players + 1)
+        dest.write('{}/pack-{}.dec'.format(directory, i // players + 1), ''.join(pack))
+        dest.append('{}/pool.dec'.format(directory), ''.join(pack))
+
+
+def card_entry(cd):
+    return {'mvid': card_mvid(cd), 'name': split_and_cut(cd, '\n', 1, ' ', (1, None))}
+
+
+def write_jsonl_stream(packs, out):
+    """
+    Write one JSON object per pack to out as packs are produced.
+    """
+    for i, pack in enumerate(packs):
+        out.write(json.dumps({'pack': i + 1, 'cards': [card_entry(cd) for cd in pack]}) + '\n')
+        out.flush()
+
+
+def write_draft(args, tree, seed, ratings=None, profiler=None):
+    """
+    Generate the packs for one pod, draft them with bots and write the packs each player opened
+    along with the cards they picked, in pick order, as their pool.
+    """
+    players = args.players
+    packs = generate(tree, players * args.packs_per_player, seed, args.workers, profiler)
+    bots = make_bots(tree.cards, seat_strategies(args.draft, players), random.Random(seed), ratings)
+    pools = draft([array('l', pack) for pack in packs], players, bots)
+
+    with open_results(args.dest_dir, args.archive, args.io_threads) as out:
+        for seat, pool in enumerate(pools):
+            directory = 'player-{}'.format(seat + 1)
+            for pack_id in range(args.packs_per_player):
+                out.write('{}/pack-{}.dec'.format(directory, pack_id + 1),
+                          ''.join(tree.cards.dec_lines(packs[pack_id * players + seat])))
+            out.write('{}/pool.dec'.format(directory), ''.join(tree.cards.dec_lines(pool)))
+
+
+def write_packs(args, tree, seed, profiler=None, ratings=None):
+    """
+    Generate the packs for the command line arguments and write them where they ask for.
+    """
+    players = args.players
+    packs_per_player = args.packs_per_player
+    dest_dir = args.dest_dir
+    count = players * packs_per_player
+
+    if args.draft is not None:
+        write_draft(args, tree, seed, ratings, profiler)
+        return
+
+    if args.jsonl:
+        try:
+            write_jsonl_stream(generate_packs(tree, count, seed, profiler), sys.stdout)
+        except BrokenPipeError:
+            # Whatever reads the packs stopped early, as head does, so nothing is left to write to
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+
+    if args.stream:
+        with open_results(dest_dir, args.archive, args.io_threads) as out:
+            write_dec_stream(generate_packs(tree, count, seed, profiler), out, players)
+        return
+
+    packs = generate(tree, count, seed, args.workers, profiler)
+    packs = [tree.cards.dec_lines(pack) for pack in packs]
+
+    random.seed(seed)
+    random.shuffle(packs)
+    players_with_packs = []
+    for i in range(players):
+        player_packs = []
+        for j in range(packs_per_player):
+            player_packs.append(packs.pop())
+        players_with_packs.append(player_packs)
+
+    with open_results(dest_dir, args.archive, args.io_threads) as out:
+        for player_id, player_packs in enumerate(players_with_packs):
+            player_pool = []
+            directory = 'player-{}'.format(player_id + 1)
+            for pack_id, player_pack in enumerate(player_packs):
+                player_pool += player_pack
+                out.write('{}/pack-{}.dec'.format(directory, pack_id + 1), ''.join(player_pack))
+            out.write('{}/pool.dec'.format(directory), ''.join(player_pool))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Generate packs for each player from a def file.')
+    arg_parser.add_argument('def_file')
+    arg_parser.add_argument('players', type=int)
+    arg_parser.add_argument('packs_per_player', type=int)
+    arg_parser.add_argument('dest_dir', nargs='?', default='results')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='Processes to generate packs with')
+    arg_parser.add_argument('--seed', default=None, help='Seed to make the packs reproducible')
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='Write packs as they are generated, dealt round robin instead '
+                            'of shuffled')
+    arg_parser.add_argument('--jsonl', action='store_true',
+                            help='Stream packs to stdout as JSON lines')
+    arg_parser.add_argument('--archive', choices=archive_kinds, default=None,
+                            help='Write the results as one archive named after dest_dir instead of '
+                            'a directory')
+    arg_parser.add_argument('--draft', default=None, metavar='BOTS',
+                            help='Draft the packs with bots, comma separated strategies for the '
+                            'seats from {}'.format(', '.join(strategies)))
+    arg_parser.add_argument('--ratings', default=None,
+                            help='JSON or CSV file rating cards by name for --draft')
+    arg_parser.add_argument('--io-threads', type=int, default=8,
+                            help='Threads to write result files with')
+    arg_parser.add_argument('--no-cache', action='store_true',
+                            help='Read the cube again instead of using the tree cache')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='Print the tree with the time spent in every node once done')
+    arg_parser.add_argument('--flamegraph', default=None,
+                            help='Write the time per node as folded stacks to a file')
+    args = arg_parser.parse_args()
+    if (args.profile or args.flamegraph) and args.workers != 1:
+        arg_parser.error('--profile and --flamegraph need --workers 1')
+    if (args.stream or args.jsonl) and args.workers != 1:
+        arg_parser.error('--stream and --jsonl generate packs in one process, '
+                         '--workers does not apply')
+    if args.draft is not None:
+        if args.stream or args.jsonl:
+            arg_parser.error('--draft cannot be combined with --stream or --jsonl')
+        try:
+            seat_strategies(args.draft, args.players)
+        except ValueError as e:
+            arg_parser.error(str(e))
+
+    profiler = None
+    if args.profile or args.flamegraph:
+        profiler = Profiler()
+    try:
+        tree = create_tree(args.def_file, None if args.no_cache else tree_cache)
+    except (DefError, OSError) as e:
+        sys.exit(str(e))
+    ratings = None
+    if args.ratings is not None:
+        try:
+            ratings = load_ratings(args.ratings, tree.cards)
+        except (ValueError, OSError) as e:
+            sys.exit(str(e))
+
+    seed = args.seed
+    if seed is None:
+        seed = random.getrandbits(64)
+
+    try:
+        write_packs(args, tree, seed, profiler, ratings)
+    except (DefError, StatementError) as e:
+        sys.exit(str(e))
+    finally:
+        if profiler is not None and args.profile:
+            profiler.report(tree)
+        if profiler is not None and args.flamegraph:
+            profiler.write_folded(args.flamegraph)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 import glob
-import inspect
+import os
 import random
+import re
 
+from array import array
 from collections import defaultdict
 
 import ply.yacc as yacc
 import ply.lex as lex
 from ply.lex import TOKEN
 
-from gatherer import get_color_identity
+from cardtable import CardDatabase, CardTable, color_bits, mask_color_order, write_database
+from quota import sample_quota
+from gatherer import prefetch_color_identities
+from treecache import TreeCache, colors_source, file_entry, manifest
 
-variables = {}
-DEBUG = False
+# NumPy is optional and slow to import, so vector_support loads it when a filter first needs it
+numpy = None
+numpy_checked = False
+
+unset = object()
 # Future Concepts: Prevent duplicates in the same pack,
 #                  Add Misc variable for remaining after all processing,
 #                  Debug for printing results
@@ -26,31 +34,346 @@ def rare_index(r):
     return r.split('/')[-1].split('.')[0]
 
 
+class DefError(ValueError):
+    """
+    A mistake in a def file, or a failure while evaluating it, with the (file, line, column) it is
+    at.
+    """
+    def __init__(self, message, pos=None):
+        super().__init__(message, pos)
+        self.message = message
+        self.pos = pos
+
+    def __str__(self):
+        if self.pos is None:
+            return self.message
+        return '{}:{}:{}: {}'.format(*self.pos, self.message)
+
+
+class StatementError(RuntimeError):
+    """
+    An unexpected error from a statement while building packs, its message starting with the
+    statement's file, line and column.
+    """
+
+
+class CardPool():
+    """
+    A live view of the cards of a rarity that can still be added to packs.
+
+    Every card has a weight, its remaining copies, kept in a Fenwick tree so that changing a weight
+    and drawing a card with probability proportional to its weight are both O(log n). Cards with no
+    weight are not in the pool.
+    """
+    def __init__(self, owner, cards, weights):
+        self.owner = owner
+        # Never changed, so the card lists of a rarity and views of a card database are used as
+        # they are
+        self.cards = cards
+        self.positions = {cd: i for i, cd in enumerate(self.cards)}
+        self.weights = [0] * len(self.cards)
+        self.tree = [0] * (len(self.cards) + 1)
+        self.size = 0
+        self.total = 0
+        for cd in self.cards:
+            self.set_weight(cd, weights[cd])
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (cd for cd, weight in zip(self.cards, self.weights) if weight > 0)
+
+    def __contains__(self, cd):
+        i = self.positions.get(cd)
+        return i is not None and self.weights[i] > 0
+
+    def __repr__(self):
+        return 'CardPool({})'.format(list(self))
+
+    def set_weight(self, cd, weight):
+        i = self.positions.get(cd)
+        if i is None:
+            return
+        weight = max(weight, 0)
+        delta = weight - self.weights[i]
+        if delta == 0:
+            return
+        self.size += (weight > 0) - (self.weights[i] > 0)
+        self.weights[i] = weight
+        self.total += delta
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def sample(self, rng=random):
+        """
+        Pick a card with probability proportional to its weight.
+        """
+        remaining = rng.randrange(self.total)
+        pos = 0
+        step = 1 << (len(self.cards).bit_length() - 1)
+        while step > 0:
+            if pos + step <= len(self.cards) and self.tree[pos + step] <= remaining:
+                pos += step
+                remaining -= self.tree[pos]
+            step >>= 1
+        return self.cards[pos]
+
+
+class CardSelection(list):
+    """
+    Cards filtered from a CardPool, drawn from by their remaining copies just like the pool.
+
+    Weights are read from the pool's copies when a card is drawn, and a selection filtered again
+    keeps them. Drawing is O(n), as building the selection already was.
+    """
+    def __init__(self, cards, weights):
+        super().__init__(cards)
+        self.weights = weights
+
+    def copy(self):
+        return CardSelection(self, self.weights)
+
+    def sample_index(self, rng=random):
+        """
+        The position of a card picked with probability proportional to its copies left.
+
+        Raises ValueError when no card has a copy left, just like extracting from an empty list.
+        """
+        weights = self.weights
+        total = sum(max(weights[cd], 0) for cd in self)
+        if total == 0:
+            raise ValueError("No copies left of the cards being extracted from")
+        remaining = rng.randrange(total)
+        for i, cd in enumerate(self):
+            remaining -= max(weights[cd], 0)
+            if remaining < 0:
+                return i
+
+
+def selection_weights(lst):
+    """
+    The copies to weight a comprehension over lst by, or None if it is not drawn from a pool.
+    """
+    if isinstance(lst, CardPool):
+        return lst.owner.card_list
+    if isinstance(lst, CardSelection):
+        return lst.weights
+    return None
+
+
+def quota_candidates(lst, pack_cards):
+    """
+    The cards of a quota's source not in the pack yet, still a selection if the source is a pool.
+    """
+    res = [cd for cd in lst if cd not in pack_cards]
+    weights = selection_weights(lst)
+    return res if weights is None else CardSelection(res, weights)
+
+
+class Availability():
+    """
+    The cards of a rarity still available, as one pool for Any and one per rarity file.
+
+    Pools are weighted by the remaining copies in card_list, an array indexed by card id that starts
+    from the rarity's copies and persists between the packs of a Context. Cards taken by the current
+    pack are held at no weight until the rarity finishes evaluating it.
+    """
+    def __init__(self, rarity):
+        self.members, file_list = rarity.membership()
+        self.card_list = array('i', [0]) * len(rarity.cards)
+        for cd in self.members:
+            self.card_list[cd] = rarity.duplication
+        self.any = CardPool(self, self.members, self.card_list)
+        self.files = {fname: CardPool(self, cards, self.card_list)
+                      for fname, cards in file_list.items()}
+        self.held = set()
+
+    def get_list(self, fname):
+        res = self.files.get(fname)
+        if res is None:
+            res = self.files[fname] = CardPool(self, [], self.card_list)
+        return res
+
+    def set_weight(self, cd, weight):
+        self.any.set_weight(cd, weight)
+        for pool in self.files.values():
+            pool.set_weight(cd, weight)
+
+    def take(self, cd):
+        """
+        Remove a card from every pool for the rest of the pack.
+        """
+        if cd in self.any.positions:
+            self.held.add(cd)
+            self.set_weight(cd, 0)
+
+    def split_copies(self, part, shares):
+        """
+        Keep only one part of the remaining copies of each card, for generating packs in parallel.
+
+        Copies are dealt to the parts in proportion to shares with a smooth weighted round robin, so
+        every part gets its fair number of copies and the copies of a card go to different parts.
+        """
+        current = [0] * len(shares)
+        total = sum(shares)
+        for cd in self.members:
+            copies = 0
+            for _ in range(self.card_list[cd]):
+                for i, share in enumerate(shares):
+                    current[i] += share
+                pick = current.index(max(current))
+                current[pick] -= total
+                copies += pick == part
+            self.card_list[cd] = copies
+            self.set_weight(cd, copies)
+
+    def release(self):
+        """
+        Return held cards to the pools with however many copies are left.
+        """
+        for cd in self.held:
+            self.set_weight(cd, self.card_list[cd])
+        self.held = set()
+
+
+class Context():
+    """
+    Everything that changes while evaluating a tree, so one loaded tree can serve many generations.
+
+    Holds the variable frames, the pack being built, the copies left of every card for each rarity
+    and the random stream. User variables live in the bottom frame and persist between rarities and
+    packs; rarities and comprehensions push frames for the names they bind.
+    """
+    def __init__(self, seed=None):
+        self.frames = [{}]
+        self.rarities = {}
+        self.slot_frames = {}
+        self.random = random if seed is None else random.Random(seed)
+        self.pack = None
+        self.pack_cards = None
+        self.available = None
+        self.cards = None
+        self.color_index = []
+        # Told about every random extraction and quota, e.g. by simulate to gather statistics
+        self.observer = None
+
+    def availability(self, rarity):
+        res = self.rarities.get(rarity)
+        if res is None:
+            res = self.rarities[rarity] = Availability(rarity)
+        return res
+
+    def start_pack(self, pack):
+        self.pack = pack
+        self.pack_cards = set(pack)
+        self.frames[0]['pack'] = pack
+
+    def lookup(self, identifier):
+        for frame in reversed(self.frames):
+            if identifier in frame:
+                return frame[identifier]
+        raise KeyError(identifier)
+
+    def assign(self, identifier, val):
+        self.frames[0][identifier] = val
+
+
+# Set by a profiler to prefix the line of every node in str(tree) with its figures
+annotator = None
+
+
+def annotate(node):
+    return '' if annotator is None else annotator(node)
+
+
 class Node():
+    # (file, line, column) of the node in its def file, set by the parser
+    pos = None
+
     def eval(*args):
         return None
 
+    def compile(self, scope):
+        return lambda frame: None
+
+
+def statement_error(expr, e):
+    """
+    The error to raise for an exception from a statement, pointing at the statement's line.
+
+    Only a ValueError, a pool running out of cards, becomes a DefError. Anything else is a bug and
+    must not be taken for a pool running out, so it stays out of the ValueError hierarchy.
+    """
+    if isinstance(e, ValueError):
+        return DefError(str(e), expr.pos)
+    return StatementError(str(DefError('{}: {}'.format(type(e).__name__, e), expr.pos)))
+
+
+def eval_statement(expr, ctx):
+    try:
+        expr.eval(ctx)
+    except DefError:
+        raise
+    except Exception as e:
+        raise statement_error(expr, e) from e
+
+
+def compile_statement(scope, expr):
+    run = scope.compile(expr)
+
+    def run_at(frame):
+        try:
+            run(frame)
+        except DefError:
+            raise
+        except Exception as e:
+            raise statement_error(expr, e) from e
+    return run_at
+
 
 class RarityListNode(Node):
     def __init__(self, lst):
         self.lst = lst
+        self.cards = None
+        self.context = None
 
     def __str__(self):
         str_nodes = []
         for node in self.lst:
             str_node = str(node)
             str_nodes.append('\n'.join('\t' + ln for ln in str_node.split('\n')))
-        return "RarityListNode:\n" + '\n'.join(str_nodes)
+        return annotate(self) + "RarityListNode:\n" + '\n'.join(str_nodes)
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        variables['pack'] = pack
+    def eval(self, pack, ctx=None):
+        """
+        Add a pack worth of cards to pack, tracking state in ctx or the tree's own context.
+        """
+        if ctx is None:
+            ctx = self.default_context()
+        ctx.start_pack(pack)
         for node in self.lst:
-            node.eval(pack)
+            node.eval(ctx)
         return True
 
+    def default_context(self):
+        if self.context is None:
+            self.context = Context()
+        return self.context
+
+    def compile(self, scope):
+        rarities = [scope.compile(node) for node in self.lst]
+
+        def run(frame):
+            for rarity in rarities:
+                rarity(frame)
+        return run
+
 
 class RarityNode(Node):
     def __init__(self, name, duplication, exprs):
@@ -58,9 +381,18 @@ class RarityNode(Node):
         self.exprs = exprs
         self.duplication = duplication
         self.file_list = defaultdict(list)
-        self.card_list = {}
-        self.file_names = glob.glob(name + '/*.dec')
-        for fname in self.file_names:
+        self.members = []
+        self.file_names = []
+        self.cards = None
+
+    def load(self, cards):
+        """
+        Read the .dec files of this rarity, adding their cards to the card table.
+        """
+        self.cards = cards
+        file_names = glob.glob(self.name + '/*.dec')
+        members = {}
+        for fname in file_names:
             with open(fname) as rare_file:
                 cur_line = ''
                 comment = True
@@ -69,34 +401,85 @@ class RarityNode(Node):
                         cur_line = line
                     else:
                         cur_line += line
-                        self.file_list[rare_index(fname)].append(cur_line)
-                        self.card_list[cur_line] = self.duplication
+                        cd = cards.add(cur_line, '{}/{}'.format(self.name, rare_index(fname)))
+                        self.file_list[rare_index(fname)].append(cd)
+                        members[cd] = None
                     comment = not comment
-        self.file_names = [rare_index(f) for f in self.file_names]
+        self.members = list(members)
+        self.file_names = [rare_index(f) for f in file_names]
+
+    def share(self, db):
+        """
+        Read cards from a card database from now on, along with which cards are in each file.
+        """
+        self.cards = db
+        self.file_list = self.members = None
+
+    def membership(self):
+        """
+        The cards of this rarity in the order they were read, and the cards of each of its files.
+
+        From a card database both are views of its mapping rather than copies.
+        """
+        if isinstance(self.cards, CardDatabase):
+            return self.cards.rarity_cards(self.name), dict(self.cards.rarity_files(self.name))
+        return self.members, self.file_list
 
     def __str__(self):
         str_exprs = []
         for expr in self.exprs:
             str_expr = str(expr)
             str_exprs.append('\n'.join('\t' + ln for ln in str_expr.split('\n')))
-        res = "RarityNode: " + self.name + ' ' + str(self.duplication) + '\n' + '\n'.join(str_exprs)
+        res = annotate(self) + "RarityNode: " + self.name + ' ' + str(self.duplication) + '\n'
+        res += '\n'.join(str_exprs)
         return res
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        added_vars = ['FileNames', '_master_card_list', '_master_file_list']
-        variables['FileNames'] = self.file_names
-        variables['_master_card_list'] = self.card_list
-        variables['_master_file_list'] = self.file_list
-        # TODO Remove the used cards at the end
+    def eval(self, ctx):
+        available = ctx.availability(self)
+        ctx.available = available
+        ctx.cards = self.cards
+        ctx.color_index = self.cards.color_masks
+        # A copy, as extracting from FileNames must not empty it for later packs
+        ctx.frames.append({'FileNames': list(self.file_names)})
 
-        for expr in self.exprs:
-            expr.eval(pack)
-        for variable in added_vars:
-            del variables[variable]
-        return pack
+        for cd in ctx.pack_cards:
+            available.take(cd)
+        try:
+            for expr in self.exprs:
+                eval_statement(expr, ctx)
+        finally:
+            available.release()
+            ctx.frames.pop()
+            ctx.available = None
+            ctx.cards = None
+            ctx.color_index = []
+        return ctx.pack
+
+    def compile(self, scope):
+        rarity = self
+        context = scope.slot('$context')
+        slots = [scope.slot(name) for name in ('FileNames', '$color_index', '$available', '$cards')]
+        pack_cards = scope.slot('$pack_cards')
+        exprs = [compile_statement(scope, expr) for expr in self.exprs]
+
+        def run(frame):
+            available = frame[context].availability(rarity)
+            values = (list(rarity.file_names), rarity.cards.color_masks, available, rarity.cards)
+            for slot, value in zip(slots, values):
+                frame[slot] = value
+            for cd in frame[pack_cards]:
+                available.take(cd)
+            try:
+                for expr in exprs:
+                    expr(frame)
+            finally:
+                available.release()
+            for slot in slots:
+                frame[slot] = unset
+        return run
 
 
 class RepeatNode(Node):
@@ -109,17 +492,27 @@ class RepeatNode(Node):
         for expr in self.exprs:
             str_expr = str(expr)
             str_exprs.append('\n'.join('\t' + ln for ln in str_expr.split('\n')))
-        res = "RepeatNode: " + str(self.n) + '\n' + '\n'.join(str_exprs)
+        res = annotate(self) + "RepeatNode: " + str(self.n) + '\n' + '\n'.join(str_exprs)
         return res
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
+    def eval(self, ctx):
         for _ in range(self.n):
             for expr in self.exprs:
-                expr.eval(pack)
-        return pack
+                eval_statement(expr, ctx)
+        return ctx.pack
+
+    def compile(self, scope):
+        n = self.n
+        exprs = [compile_statement(scope, expr) for expr in self.exprs]
+
+        def run(frame):
+            for _ in range(n):
+                for expr in exprs:
+                    expr(frame)
+        return run
 
 
 class ListNode(Node):
@@ -131,14 +524,18 @@ class ListNode(Node):
         for expr in self.vals:
             str_expr = str(expr)
             str_exprs.append('\n'.join('\t' + ln for ln in str_expr.split('\n')))
-        res = "ListNode:\n" + '\n'.join(str_exprs)
+        res = annotate(self) + "ListNode:\n" + '\n'.join(str_exprs)
         return res
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        return [x.eval(pack) for x in self.vals]
+    def eval(self, ctx):
+        return [x.eval(ctx) for x in self.vals]
+
+    def compile(self, scope):
+        vals = [scope.compile(x) for x in self.vals]
+        return lambda frame: [x(frame) for x in vals]
 
 
 class FunctionNode(Node):
@@ -151,14 +548,28 @@ class FunctionNode(Node):
         for arg in self.args:
             str_arg = str(arg)
             str_args.append('\n'.join('\t' + ln for ln in str_arg.split('\n')))
-        res = "FunctionNode: " + self.fun + '\n' + '\n'.join(str_args)
+        res = annotate(self) + "FunctionNode: " + self.fun + '\n' + '\n'.join(str_args)
         return res
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        return functions[self.fun](*[x.eval(pack) for x in self.args])
+    def eval(self, ctx):
+        if self.fun in context_functions:
+            return functions[self.fun](ctx, *[x.eval(ctx) for x in self.args])
+        return functions[self.fun](*[x.eval(ctx) for x in self.args])
+
+    def compile(self, scope):
+        args = [scope.compile(x) for x in self.args]
+        if self.fun == 'GetList':
+            available = scope.slot('$available')
+            fname, = args
+            return lambda frame: frame[available].get_list(fname(frame))
+        if self.fun == 'GetColors':
+            color_index = scope.slot('$color_index')
+            cd, = args
+            return lambda frame: list(mask_color_order[frame[color_index][cd(frame)]])
+        return compile_call(functions[self.fun], args)
 
 
 class AssignNode(Node):
@@ -168,7 +579,7 @@ class AssignNode(Node):
         self.val = val
 
     def __str__(self):
-        res = "AssignNode: " + self.fun.__name__ + ' ' + str(self.targets)
+        res = annotate(self) + "AssignNode: " + self.fun.__name__ + ' ' + str(self.targets)
         str_val = str(self.val)
         res += '\n' + '\n'.join('\t' + ln for ln in str_val.split('\n'))
         return res
@@ -176,14 +587,40 @@ class AssignNode(Node):
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        res = None
-        try:
-            res = self.fun(self.val.eval(pack), *self.targets)
-        except Exception as e:
-            print('Failed to assign: ', self)
-            raise
-        return res
+    def eval(self, ctx):
+        val = self.val.eval(ctx)
+        if self.fun is random_assign and ctx.observer is not None:
+            ctx.observer.extracting(self, val)
+        return self.fun(ctx, val, *self.targets)
+
+    def compile(self, scope):
+        val = scope.compile(self.val)
+        slots = [None if target == '_' else scope.slot(target) for target in self.targets]
+        if self.fun is update_variable:
+            slot = slots[0]
+
+            def run(frame):
+                frame[slot] = val(frame)
+        elif self.fun is random_assign:
+            slot = slots[0]
+            context = scope.slot('$context')
+            node = self
+
+            def run(frame):
+                lst = val(frame)
+                ctx = frame[context]
+                if ctx.observer is not None:
+                    ctx.observer.extracting(node, lst)
+                frame[slot] = extract(lst, ctx.random)
+        else:
+            def run(frame):
+                lst = val(frame)
+                if len(slots) < len(lst):
+                    print("Not splitting a large enough tuple")
+                for x, slot in zip(lst, slots):
+                    if slot is not None:
+                        frame[slot] = x
+        return run
 
 
 class AddNode(Node):
@@ -191,7 +628,7 @@ class AddNode(Node):
         self.val = val
 
     def __str__(self):
-        res = "AddNode:\n"
+        res = annotate(self) + "AddNode:\n"
         str_val = str(self.val)
         res += '\n'.join('\t' + ln for ln in str_val.split('\n'))
         return res
@@ -199,14 +636,106 @@ class AddNode(Node):
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        res = self.val.eval(pack)
-        if DEBUG:
-            print('Adding', res)
-        if res in pack:
+    def eval(self, ctx):
+        res = self.val.eval(ctx)
+        if res in ctx.pack_cards:
             print('Double adding', res)
-        pack.append(res)
-        variables['_master_card_list'][res] -= 1
+        ctx.pack.append(res)
+        ctx.pack_cards.add(res)
+        ctx.available.take(res)
+        ctx.available.card_list[res] -= 1
+
+    def compile(self, scope):
+        val = scope.compile(self.val)
+        pack = scope.slot('pack')
+        pack_cards = scope.slot('$pack_cards')
+        available = scope.slot('$available')
+
+        def run(frame):
+            res = val(frame)
+            if res in frame[pack_cards]:
+                print('Double adding', res)
+            frame[pack].append(res)
+            frame[pack_cards].add(res)
+            frame[available].take(res)
+            frame[available].card_list[res] -= 1
+        return run
+
+
+class QuotaNode(Node):
+    """
+    Add n cards from source to the pack, with bounds on how many of them match each filter.
+
+    Every bound is a comprehension over the candidates in '$quota_source', so filters are
+    evaluated and vectorized just like [List where Prop].
+    """
+    def __init__(self, n, source, quotas):
+        self.n = n
+        self.source = source
+        self.quotas = quotas
+        self.bounds = []
+        for kind, count, prop in quotas:
+            low, high = {'AtLeast': (count, n), 'AtMost': (0, count),
+                         'Exactly': (count, count)}[kind]
+            self.bounds.append((low, high, ComprehensionNode(IdNode('$quota_source'), prop)))
+
+    def __str__(self):
+        str_quotas = []
+        for kind, count, prop in self.quotas:
+            str_prop = '\n'.join('\t' + ln for ln in str(prop).split('\n'))
+            str_quota = kind + ' ' + str(count) + '\n' + str_prop
+            str_quotas.append('\n'.join('\t' + ln for ln in str_quota.split('\n')))
+        str_source = '\n'.join('\t' + ln for ln in str(self.source).split('\n'))
+        return (annotate(self) + "QuotaNode: " + str(self.n) + '\n' + str_source + '\n'
+                + '\n'.join(str_quotas))
+
+    def __repr__(self):
+        return str(self)
+
+    def eval(self, ctx):
+        candidates = quota_candidates(self.source.eval(ctx), ctx.pack_cards)
+        ctx.frames.append({'$quota_source': candidates})
+        try:
+            bounds = [(low, high, set(lst.eval(ctx))) for low, high, lst in self.bounds]
+        finally:
+            ctx.frames.pop()
+        if ctx.observer is not None:
+            ctx.observer.drawing_quota(self, candidates, bounds)
+        for cd in sample_quota(candidates, ctx.available.card_list, self.n, bounds, ctx.random):
+            ctx.pack.append(cd)
+            ctx.pack_cards.add(cd)
+            ctx.available.take(cd)
+            ctx.available.card_list[cd] -= 1
+        return ctx.pack
+
+    def compile(self, scope):
+        n = self.n
+        source = scope.compile(self.source)
+        source_slot = scope.slot('$quota_source')
+        bounds = [(low, high, scope.compile(lst)) for low, high, lst in self.bounds]
+        context = scope.slot('$context')
+        pack = scope.slot('pack')
+        pack_cards = scope.slot('$pack_cards')
+        available = scope.slot('$available')
+        node = self
+
+        def run(frame):
+            candidates = quota_candidates(source(frame), frame[pack_cards])
+            frame[source_slot] = candidates
+            try:
+                cur_bounds = [(low, high, set(lst(frame))) for low, high, lst in bounds]
+            finally:
+                frame[source_slot] = unset
+            ctx = frame[context]
+            if ctx.observer is not None:
+                ctx.observer.drawing_quota(node, candidates, cur_bounds)
+            copies = frame[available].card_list
+            for cd in sample_quota(candidates, copies, n, cur_bounds, ctx.random):
+                frame[pack].append(cd)
+                frame[pack_cards].add(cd)
+                frame[available].take(cd)
+                frame[available].card_list[cd] -= 1
+        return run
 
 
 class IdNode(Node):
@@ -214,13 +743,24 @@ class IdNode(Node):
         self.id = identifier
 
     def __str__(self):
-        return "IdNode: " + self.id
+        return annotate(self) + "IdNode: " + self.id
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        return variables[self.id]
+    def eval(self, ctx):
+        return ctx.lookup(self.id)
+
+    def compile(self, scope):
+        slot = scope.slot(self.id)
+        identifier = self.id
+
+        def run(frame):
+            res = frame[slot]
+            if res is unset:
+                raise KeyError(identifier)
+            return res
+        return run
 
 
 class ConstantNode(Node):
@@ -228,25 +768,32 @@ class ConstantNode(Node):
         self.value = value
 
     def __str__(self):
-        return "ConstantNode: " + str(self.value)
+        return annotate(self) + "ConstantNode: " + str(self.value)
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
+    def eval(self, ctx):
         return self.value
 
+    def compile(self, scope):
+        value = self.value
+        return lambda frame: value
+
 
 class AnyNode(Node):
     def __str__(self):
-        return "AnyNode"
+        return annotate(self) + "AnyNode"
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        combined_card_list = [k for k in variables['_master_card_list'] if k not in pack]
-        return combined_card_list
+    def eval(self, ctx):
+        return ctx.available.any
+
+    def compile(self, scope):
+        available = scope.slot('$available')
+        return lambda frame: frame[available].any
 
 
 class ComprehensionNode(Node):
@@ -255,38 +802,80 @@ class ComprehensionNode(Node):
         self.prop = prop
 
     def __str__(self):
+        # The source gets its own line like any child, so its annotation starts a line when
+        # profiling
+        str_source = '\n'.join('\t' + ln for ln in str(self.source).split('\n'))
         str_prop = '\n'.join('\t' + ln for ln in str(self.prop).split('\n'))
-        res = "ComprehensionNode: " + str(self.source) + '\n' + str_prop
+        res = annotate(self) + "ComprehensionNode:\n" + str_source + '\n' + str_prop
         return res
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        lst = self.source.eval(pack)
+    def eval(self, ctx):
+        lst = self.source.eval(ctx)
         if len(lst) == 0:
             return []
-        res = []
-        if isinstance(lst[0], (list, tuple)):
-            for x in lst:
-                added_variables = []
-                for i, val in enumerate(x):
-                    variables['X{}'.format(i)] = val
-                    added_variables.append('X{}'.format(i))
-                if self.prop.eval(pack):
-                    res.append(x)
-                for var in added_variables:
-                    del variables[var]
-        else:
-            for x in lst:
-                variables['X'] = x
-                added_variables = ['X']
-                if self.prop.eval(pack):
-                    res.append(x)
-                for var in added_variables:
-                    del variables[var]
+        if ctx.cards is not None and vector_support():
+            vector_prop = vectorize_prop(self.prop, lambda node: node.eval)
+            # Only card ids have color masks, and only lists from a pool are sure to hold card ids
+            if vector_prop is not None and selection_weights(lst) is not None:
+                return filter_cards(ctx.cards, lst, vector_prop, ctx)
+        weights = selection_weights(lst)
+        res = [] if weights is None else CardSelection((), weights)
+        frame = {}
+        ctx.frames.append(frame)
+        try:
+            if isinstance(next(iter(lst)), (list, tuple)):
+                for x in lst:
+                    frame.clear()
+                    for i, val in enumerate(x):
+                        frame['X{}'.format(i)] = val
+                    if self.prop.eval(ctx):
+                        res.append(x)
+            else:
+                for x in lst:
+                    frame['X'] = x
+                    if self.prop.eval(ctx):
+                        res.append(x)
+        finally:
+            ctx.frames.pop()
         return res
 
+    def compile(self, scope):
+        source = scope.compile(self.source)
+        x_slot = scope.slot('X')
+        prop = scope.compile(self.prop)
+        tuple_slots = sorted((int(name[1:]), slot) for name, slot in scope.slots.items()
+                             if re.fullmatch('X[0-9]+', name))
+        vector_prop = None
+        if vector_support():
+            vector_prop = vectorize_prop(self.prop, scope.compile)
+        cards = scope.slot('$cards')
+
+        def run(frame):
+            lst = source(frame)
+            if len(lst) == 0:
+                return []
+            if vector_prop is not None and selection_weights(lst) is not None:
+                return filter_cards(frame[cards], lst, vector_prop, frame)
+            weights = selection_weights(lst)
+            res = [] if weights is None else CardSelection((), weights)
+            if isinstance(next(iter(lst)), (list, tuple)):
+                for x in lst:
+                    for i, slot in tuple_slots:
+                        if i < len(x):
+                            frame[slot] = x[i]
+                    if prop(frame):
+                        res.append(x)
+            else:
+                for x in lst:
+                    frame[x_slot] = x
+                    if prop(frame):
+                        res.append(x)
+            return res
+        return run
+
 
 class PropositionNode(Node):
     def __init__(self, fun, *vals):
@@ -298,33 +887,322 @@ class PropositionNode(Node):
         for val in self.vals:
             str_val = str(val)
             str_vals.append('\n'.join('\t' + ln for ln in str_val.split('\n')))
-        res = "PropositionNode: " + self.fun + '\n' + '\n'.join(str_vals)
+        res = annotate(self) + "PropositionNode: " + self.fun + '\n' + '\n'.join(str_vals)
         return res
 
     def __repr__(self):
         return str(self)
 
-    def eval(self, pack):
-        return propositions[self.fun](*(v.eval(pack) for v in self.vals))
+    def eval(self, ctx):
+        return propositions[self.fun](*(v.eval(ctx) for v in self.vals))
+
+    def compile(self, scope):
+        vals = [scope.compile(v) for v in self.vals]
+        if self.fun == 'Id':
+            return vals[0]
+        if self.fun == 'Not':
+            val, = vals
+            return lambda frame: not val(frame)
+        if self.fun in ('And', 'Or') and len(vals) == 2:
+            a, b = vals
+            if self.fun == 'And':
+                return lambda frame: a(frame) and b(frame)
+            return lambda frame: a(frame) or b(frame)
+        if self.fun == 'And':
+            return lambda frame: all(v(frame) for v in vals)
+        if self.fun == 'Or':
+            return lambda frame: any(v(frame) for v in vals)
+        return compile_call(propositions[self.fun], vals)
+
+
+class HoistNode(Node):
+    """
+    A value that cannot change within its scope, a Repeat or a single statement, put there by
+    Hoister.
+
+    It is computed the first time it is needed after the scope's ForgetNode and reused until the
+    next one, so nothing is evaluated that would not have been before. Where the consumer could
+    change a list, such as an extraction, it gets a copy.
+    """
+    def __init__(self, name, val, copy):
+        self.name = name
+        self.val = val
+        self.copy = copy
+
+    def __str__(self):
+        str_val = '\n'.join('\t' + ln for ln in str(self.val).split('\n'))
+        return annotate(self) + "HoistNode: " + self.name + '\n' + str_val
+
+    def __repr__(self):
+        return str(self)
+
+    def eval(self, ctx):
+        frame = ctx.frames[0]
+        res = frame.get(self.name, unset)
+        if res is unset:
+            res = frame[self.name] = self.val.eval(ctx)
+        return res.copy() if self.copy and isinstance(res, list) else res
+
+    def compile(self, scope):
+        slot = scope.slot(self.name)
+        val = scope.compile(self.val)
+        copy = self.copy
+
+        def run(frame):
+            res = frame[slot]
+            if res is unset:
+                res = frame[slot] = val(frame)
+            return res.copy() if copy and isinstance(res, list) else res
+        return run
+
+
+class ForgetNode(Node):
+    """
+    Start a new scope for hoisted values, so each is computed again the next time it is needed.
+    """
+    def __init__(self, names):
+        self.names = names
+
+    def __str__(self):
+        return annotate(self) + "ForgetNode: " + ', '.join(self.names)
+
+    def __repr__(self):
+        return str(self)
+
+    def eval(self, ctx):
+        for name in self.names:
+            ctx.frames[0].pop(name, None)
+
+    def compile(self, scope):
+        slots = [scope.slot(name) for name in self.names]
+
+        def run(frame):
+            for slot in slots:
+                frame[slot] = unset
+        return run
 
 
-def split_list(lst, *ids):
+def child_nodes(node):
+    if isinstance(node, (FunctionNode, ListNode)):
+        return node.args if isinstance(node, FunctionNode) else node.vals
+    if isinstance(node, PropositionNode):
+        return node.vals
+    if isinstance(node, ComprehensionNode):
+        return [node.source, node.prop]
+    if isinstance(node, HoistNode):
+        return [node.val]
+    return []
+
+
+def uses_x(node):
+    """
+    Whether a value depends on the comprehension variable, so cannot be computed once per filter.
+    """
+    if isinstance(node, IdNode):
+        return re.fullmatch('X[0-9]*', node.id) is not None
+    if isinstance(node, HoistNode):
+        return False
+    return isinstance(node, ComprehensionNode) or any(uses_x(child) for child in child_nodes(node))
+
+
+def is_x_colors(node):
+    return (isinstance(node, FunctionNode) and node.fun == 'GetColors' and len(node.args) == 1 and
+            isinstance(node.args[0], IdNode) and node.args[0].id == 'X')
+
+
+def list_mask(lst):
+    """
+    The bitmask of the colors in a list, or None if it holds anything that is not a color.
+    """
+    res = 0
+    for color in lst:
+        if not isinstance(color, str) or color not in color_bits:
+            return None
+        res |= color_bits[color]
+    return res
+
+
+def loose_mask(lst):
+    """
+    The bitmask of the colors in a list, ignoring anything else.
+    """
+    res = 0
+    for color in lst:
+        if isinstance(color, str):
+            res |= color_bits.get(color, 0)
+    return res
+
+
+def vector_support():
+    """
+    Import NumPy the first time a comprehension could be vectorized, returning whether it is there.
+    """
+    global numpy, numpy_checked, popcount
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            return False
+        popcount = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.int64)
+    return numpy is not None
+
+
+def vectorize_count(node, lower):
+    """
+    Vectorize the number of colors in GetColors(X) or Intersect(GetColors(X), List).
+    """
+    if is_x_colors(node):
+        return lambda env, masks: popcount[masks]
+    if isinstance(node, FunctionNode) and node.fun == 'Intersect' and len(node.args) == 2:
+        a, b = node.args
+        if is_x_colors(b):
+            a, b = b, a
+        if is_x_colors(a) and not uses_x(b):
+            other = lower(b)
+            return lambda env, masks: popcount[masks & loose_mask(other(env))]
+    return None
+
+
+def vectorize_prop(node, lower):
+    """
+    Turn a comprehension filter on card colors into a function computing a boolean mask over an
+    array of color bitmasks, or None if the filter has some other shape.
+
+    lower(node) gives a function of the evaluation environment for values that do not use X, so
+    they are computed once per filter instead of once per card.
+    """
+    if not uses_x(node):
+        value = lower(node)
+        return lambda env, masks: numpy.full(len(masks), bool(value(env)))
+    if not isinstance(node, PropositionNode):
+        return None
+    fun, vals = node.fun, node.vals
+    if fun in ('And', 'Or'):
+        parts = [vectorize_prop(v, lower) for v in vals]
+        if None in parts or len(parts) == 0:
+            return None
+        combine = numpy.logical_and if fun == 'And' else numpy.logical_or
+
+        def run(env, masks):
+            res = parts[0](env, masks)
+            for part in parts[1:]:
+                # As with and and or, a part is only evaluated if some card still depends on it
+                if (fun == 'And' and not res.any()) or (fun == 'Or' and res.all()):
+                    break
+                res = combine(res, part(env, masks))
+            return res
+        return run
+    if fun in ('Not', 'Id') and len(vals) == 1:
+        part = vectorize_prop(vals[0], lower)
+        if part is None or fun == 'Id':
+            return part
+        return lambda env, masks: numpy.logical_not(part(env, masks))
+    if fun in ('Subset', 'Intersects') and len(vals) == 2:
+        a, b = vals
+        if is_x_colors(a) and not uses_x(b):
+            other = lower(b)
+            if fun == 'Subset':
+                return lambda env, masks: (masks & (0xff ^ loose_mask(other(env)))) == 0
+            return lambda env, masks: (masks & loose_mask(other(env))) != 0
+        if is_x_colors(b) and not uses_x(a):
+            other = lower(a)
+            if fun == 'Intersects':
+                return lambda env, masks: (masks & loose_mask(other(env))) != 0
+
+            def subset_of_x(env, masks):
+                required = list_mask(other(env))
+                if required is None:
+                    return numpy.zeros(len(masks), dtype=bool)
+                return (masks & required) == required
+            return subset_of_x
+        return None
+    if fun in ('ContainsAtLeast', 'ContainsExactly') and len(vals) == 2 and not uses_x(vals[1]):
+        counts = vectorize_count(vals[0], lower)
+        if counts is None:
+            return None
+        n = lower(vals[1])
+        if fun == 'ContainsAtLeast':
+            return lambda env, masks: counts(env, masks) >= n(env)
+        return lambda env, masks: counts(env, masks) == n(env)
+    if (fun == 'Contains' and len(vals) > 1 and is_x_colors(vals[0])
+            and not any(uses_x(v) for v in vals[1:])):
+        others = [lower(v) for v in vals[1:]]
+
+        def contains_all(env, masks):
+            required = list_mask([other(env) for other in others])
+            if required is None:
+                return numpy.zeros(len(masks), dtype=bool)
+            return (masks & required) == required
+        return contains_all
+    return None
+
+
+def filter_cards(cards, lst, vector_prop, env):
+    """
+    Filter card ids with a vectorized proposition, keeping the order they are iterated in.
+    """
+    if isinstance(lst, CardPool):
+        ids = numpy.asarray(lst.cards, dtype=numpy.intp)[numpy.asarray(lst.weights) > 0]
+    else:
+        ids = numpy.asarray(lst, dtype=numpy.intp)
+    masks = numpy.frombuffer(cards.color_masks, dtype=numpy.uint8)[ids]
+    res = ids[vector_prop(env, masks)].tolist()
+    weights = selection_weights(lst)
+    return res if weights is None else CardSelection(res, weights)
+
+
+def compile_call(fun, args):
+    """
+    Build a closure calling fun on compiled arguments without packing them on every call.
+    """
+    if len(args) == 1:
+        a, = args
+        return lambda frame: fun(a(frame))
+    if len(args) == 2:
+        a, b = args
+        return lambda frame: fun(a(frame), b(frame))
+    if len(args) == 3:
+        a, b, c = args
+        return lambda frame: fun(a(frame), b(frame), c(frame))
+    return lambda frame: fun(*[arg(frame) for arg in args])
+
+
+def split_list(ctx, lst, *ids):
     if len(ids) < len(lst):
         print("Not splitting a large enough tuple")
     for val, identifier in zip(lst, ids):
         if identifier != '_':
-            variables[identifier] = val
+            ctx.assign(identifier, val)
 
 
-def random_assign(lst, identifier):
+def extract(lst, rng=random):
+    """
+    Pull a random element out of a list, or a card weighted by its copies left out of a card pool or
+    a selection from one.
+    """
     if len(lst) == 0:
             raise ValueError("Empty list being extracted from")
-    i = random.randint(0, len(lst) - 1)
-    variables[identifier] = lst.pop(i)
+    if isinstance(lst, CardPool):
+        # Extracting from a live pool takes the card out of every pool for this pack
+        res = lst.sample(rng)
+        lst.owner.take(res)
+        return res
+    if isinstance(lst, CardSelection):
+        return lst.pop(lst.sample_index(rng))
+    if not isinstance(lst, list):
+        # Color sets are immutable so extract from a copy in a stable order
+        lst = sorted(lst)
+    i = rng.randint(0, len(lst) - 1)
+    return lst.pop(i)
+
+
+def random_assign(ctx, lst, identifier):
+    ctx.assign(identifier, extract(lst, ctx.random))
 
 
-def update_variable(val, identifier):
-    variables[identifier] = val
+def update_variable(ctx, val, identifier):
+    ctx.assign(identifier, val)
 
 
 def rotate(lst, n):
@@ -335,11 +1213,9 @@ def following(lst, val):
     return lst[(lst.index(val) + 1) % len(lst)]
 
 
-def get_color(cd):
-    res = list(get_color_identity(cd))
-    if 'Colorless' in res:
-        res.remove('Colorless')
-    return res
+def get_color(ctx, cd):
+    # A fresh list, as defs may rotate or extract from the colors they get
+    return list(mask_color_order[ctx.color_index[cd]])
 
 
 def zip_lists(*args):
@@ -347,26 +1223,31 @@ def zip_lists(*args):
     return res
 
 
-def get_list(fname):
-    res = [cd for cd in variables['_master_file_list'][fname] if cd not in variables['pack']]
-    return res
+def get_list(ctx, fname):
+    return ctx.available.get_list(fname)
 
 
 def concatenate(lst, val):
-    return lst + val
+    return list(lst) + list(val)
+
+
+def as_set(a):
+    if isinstance(a, (set, frozenset)):
+        return a
+    return set(a)
 
 
 def intersects(a, b):
-    return len(set(a) & set(b)) > 0
+    return not as_set(a).isdisjoint(b)
 
 
 def intersect(a, b):
-    res = list(set(a) & set(b))
+    res = list(as_set(a).intersection(b))
     return res
 
 
 def subset(a, b):
-    return len(set(a) & set(b)) == len(a)
+    return as_set(a).issubset(b)
 
 
 def contains_at_least(a, n):
@@ -406,6 +1287,8 @@ def id_prop(p):
     return p
 
 
+# Functions that are passed the evaluation context before their arguments
+context_functions = {'GetColors', 'GetList'}
 functions = {
     'Rotate': rotate,
     'Zip': zip_lists,
@@ -426,20 +1309,292 @@ propositions = {
     'Not': not_prop,
     'Id': id_prop
 }
+# The fewest and most arguments of every function and proposition, None for no limit
+arities = {
+    'Rotate': (2, 2),
+    'Zip': (1, None),
+    'Following': (2, 2),
+    'GetColors': (1, 1),
+    'GetList': (1, 1),
+    'Concat': (2, 2),
+    'Intersect': (2, 2),
+    'Intersects': (2, 2),
+    'ContainsAtLeast': (2, 2),
+    'ContainsExactly': (2, 2),
+    'Contains': (2, None),
+    'Subset': (2, 2),
+    'Or': (1, None),
+    'And': (1, None),
+    'Not': (1, 1),
+    'Id': (1, 1)
+}
+
+
+def check_arity(node, name, count):
+    least, most = arities[name]
+    if count >= least and (most is None or count <= most):
+        return
+    if most is None:
+        expected = '{} or more arguments'.format(least)
+    elif least == most:
+        expected = '{} argument{}'.format(least, 's' if least != 1 else '')
+    else:
+        expected = '{} to {} arguments'.format(least, most)
+    raise DefError('{} takes {}, not {}'.format(name, expected, count), node.pos)
+
+
+def validate(node, defined, in_comprehension=False):
+    """
+    Raise a DefError for the first call with the wrong number of arguments or name used before
+    anything is assigned to it, adding the names node assigns to defined.
+    """
+    if isinstance(node, IdNode):
+        if node.id not in defined and not (in_comprehension and re.fullmatch('X[0-9]*', node.id)):
+            raise DefError("Unknown name '{}'".format(node.id), node.pos)
+    elif isinstance(node, AssignNode):
+        validate(node.val, defined, in_comprehension)
+        defined.update(target for target in node.targets if target != '_')
+    elif isinstance(node, ComprehensionNode):
+        validate(node.source, defined, in_comprehension)
+        validate(node.prop, defined, True)
+    elif isinstance(node, QuotaNode):
+        validate(node.source, defined, in_comprehension)
+        for _, _, prop in node.quotas:
+            validate(prop, defined, True)
+    elif isinstance(node, (FunctionNode, PropositionNode)):
+        children = node.args if isinstance(node, FunctionNode) else node.vals
+        check_arity(node, node.fun, len(children))
+        for child in children:
+            validate(child, defined, in_comprehension)
+    elif isinstance(node, (RarityListNode, RarityNode, RepeatNode)):
+        for child in node.lst if isinstance(node, RarityListNode) else node.exprs:
+            validate(child, defined, in_comprehension)
+    elif isinstance(node, ListNode):
+        for child in node.vals:
+            validate(child, defined, in_comprehension)
+    elif isinstance(node, AddNode):
+        validate(node.val, defined, in_comprehension)
+
+
+def free_names(node):
+    """
+    Every name a value reads, with the comprehension variables of any comprehension in it.
+    """
+    if isinstance(node, IdNode):
+        return {node.id}
+    return set().union(*(free_names(child) for child in child_nodes(node)))
+
+
+def uses_pack_state(node, pack_names=()):
+    """
+    Whether a value depends on the cards already in the pack, which change between iterations.
+
+    pack_names are the variables that can hold such a value, like a pool from GetList.
+    """
+    if isinstance(node, AnyNode) or isinstance(node, FunctionNode) and node.fun == 'GetList':
+        return True
+    if isinstance(node, IdNode):
+        return node.id in ('pack', '$quota_source') or node.id in pack_names
+    return any(uses_pack_state(child, pack_names) for child in child_nodes(node))
+
+
+def tree_assignments(tree):
+    """
+    Every assignment in a tree, including those in Repeat blocks.
+    """
+    assigns = []
+    blocks = [rarity.exprs for rarity in tree.lst]
+    while blocks:
+        for expr in blocks.pop():
+            if isinstance(expr, AssignNode):
+                assigns.append(expr)
+            elif isinstance(expr, RepeatNode):
+                blocks.append(expr.exprs)
+    return assigns
+
+
+def pack_state_names(assigns):
+    """
+    Every variable assigned a value that depends on the pack, directly or through another one.
+    """
+    res = set()
+    changed = True
+    while changed:
+        changed = False
+        for expr in assigns:
+            if not res.issuperset(expr.targets) and uses_pack_state(expr.val, res):
+                res.update(expr.targets)
+                changed = True
+    return res
+
+
+def assigned_names(exprs):
+    """
+    Every name a block changes, including the lists it extracts from.
+    """
+    res = set()
+    for expr in exprs:
+        if isinstance(expr, AssignNode):
+            res.update(expr.targets)
+            if expr.fun is random_assign and isinstance(expr.val, IdNode):
+                res.add(expr.val.id)
+        elif isinstance(expr, RepeatNode):
+            res |= assigned_names(expr.exprs)
+    return res
+
+
+def list_aliases(assigns):
+    """
+    The names each name can share a list with, since A = B binds A to the very list B holds.
+    """
+    res = {}
+    for expr in assigns:
+        if expr.fun is update_variable and isinstance(expr.val, IdNode):
+            target, source = expr.targets[0], expr.val.id
+            group = res.get(target, {target}) | res.get(source, {source})
+            for name in group:
+                res[name] = group
+    return res
+
+
+def nested_list(node):
+    """
+    Whether a value builds lists inside lists, which a shallow copy would leave shared.
+    """
+    if isinstance(node, ListNode) and any(isinstance(val, ListNode) for val in node.vals):
+        return True
+    return any(nested_list(child) for child in child_nodes(node))
+
+
+class Loop():
+    """
+    A Repeat being hoisted out of, with the names its body assigns and the values hoisted to it.
+
+    A name counts as assigned when any name that can share its list is, so changing the list through
+    an alias also keeps values reading it in the loop.
+    """
+    def __init__(self, node, aliases):
+        self.node = node
+        self.assigned = set()
+        for name in assigned_names(node.exprs):
+            self.assigned |= aliases.get(name, {name})
+        self.hoisted = []
+
+
+class Hoister():
+    """
+    Rewrites a tree so values that cannot change within a scope are computed once there.
+
+    A value is hoisted out of the outermost Repeat whose body assigns none of the names it reads,
+    as long as it does not depend on the pack, even through a variable holding a pool. Otherwise
+    a part of a comprehension's filter that does not use X is hoisted to the statement it is in,
+    which also allows it to depend on the pack since nothing is added to it before the statement's
+    comprehensions are evaluated.
+    """
+    def __init__(self):
+        self.count = 0
+        self.pack_names = set()
+        self.aliases = {}
+
+    def tree(self, tree):
+        assigns = tree_assignments(tree)
+        self.pack_names = pack_state_names(assigns)
+        self.aliases = list_aliases(assigns)
+        for rarity in tree.lst:
+            rarity.exprs = self.block(rarity.exprs, [])
+        return tree
+
+    def block(self, exprs, loops):
+        res = []
+        for expr in exprs:
+            if isinstance(expr, RepeatNode):
+                loop = Loop(expr, self.aliases)
+                expr.exprs = self.block(expr.exprs, loops + [loop])
+                if loop.hoisted:
+                    res.append(ForgetNode(loop.hoisted))
+            else:
+                hoisted = []
+                self.statement(expr, loops, hoisted)
+                if hoisted:
+                    res.append(ForgetNode(hoisted))
+            res.append(expr)
+        return res
+
+    def statement(self, expr, loops, hoisted):
+        if isinstance(expr, (AssignNode, AddNode)):
+            expr.val = self.value(expr.val, True, loops, hoisted, False, False)
+        elif isinstance(expr, QuotaNode):
+            expr.source = self.value(expr.source, False, loops, hoisted, False, False)
+            for _, _, lst in expr.bounds:
+                lst.prop = self.value(lst.prop, False, loops, hoisted, True, False)
+            expr.quotas = [(kind, count, lst.prop)
+                           for (kind, count, _), (_, _, lst) in zip(expr.quotas, expr.bounds)]
+
+    def value(self, node, copy, loops, hoisted, in_prop, in_hoisted):
+        """
+        The node to evaluate in place of node, hoisting it or its parts where they are invariant.
+
+        copy is whether its consumer could change a list, in_prop whether it is in a comprehension's
+        filter and in_hoisted whether it is already part of a hoisted value outside any filter.
+        """
+        if not isinstance(node, (FunctionNode, ListNode, ComprehensionNode, PropositionNode)):
+            return node
+        scope = None
+        if not nested_list(node):
+            names = free_names(node)
+            uses_x = in_prop and any(re.fullmatch('X[0-9]*', name) for name in names)
+            if not in_hoisted and not uses_x and not uses_pack_state(node, self.pack_names):
+                scope = next((loop.hoisted for loop in loops
+                              if loop.node.n > 1 and loop.assigned.isdisjoint(names)), None)
+            if scope is None and in_prop and not uses_x and not in_hoisted:
+                scope = hoisted
+        inner = in_hoisted or scope is not None
+        if isinstance(node, FunctionNode):
+            node.args = [self.value(arg, False, loops, hoisted, in_prop, inner)
+                         for arg in node.args]
+        elif isinstance(node, PropositionNode):
+            node.vals = tuple(self.value(val, False, loops, hoisted, in_prop, inner)
+                              for val in node.vals)
+        elif isinstance(node, ListNode):
+            node.vals = [self.value(val, True, loops, hoisted, in_prop, inner) for val in node.vals]
+        else:
+            node.source = self.value(node.source, False, loops, hoisted, in_prop, inner)
+            # The filter runs once per element even within a hoisted value, so its parts are
+            # hoisted too
+            node.prop = self.value(node.prop, False, loops, hoisted, True, False)
+        if scope is None:
+            return node
+        name = '$hoisted{}'.format(self.count)
+        self.count += 1
+        scope.append(name)
+        res = HoistNode(name, node, copy)
+        res.pos = node.pos
+        return res
+
+
+def hoist_invariants(tree):
+    """
+    Compute values that do not change within a Repeat or a comprehension once per scope.
+    """
+    return Hoister().tree(tree)
+
+
+def at(node, p, n):
+    """
+    Give a node the position of the n-th symbol of the production it was built from.
+    """
+    node.pos = (p.lexer.filename, p.lineno(n), find_column(p.lexer.lexdata, p.lexpos(n)))
+    return node
 
 
 def p_start(p):
     """start : rarity_list"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = RarityListNode(p[1])
+    p[0] = at(RarityListNode(p[1]), p, 1)
 
 
 def p_rarity_list(p):
     """rarity_list : rarity
                    | rarity_list rarity"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
     if len(p) == 3:
         p[0] = p[1] + [p[2]]
     else:
@@ -449,8 +1604,6 @@ def p_rarity_list(p):
 def p_exprs_list(p):
     """exprs : expression
              | exprs expression"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
     if len(p) == 3:
         p[0] = p[1] + [p[2]]
     else:
@@ -459,123 +1612,112 @@ def p_exprs_list(p):
 
 def p_rarity(p):
     """rarity : RARITY_NAME INTEGER exprs"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = RarityNode(p[1], p[2], p[3])
+    p[0] = at(RarityNode(p[1], p[2], p[3]), p, 1)
 
 
 def p_expression_repeat(p):
     """expression : REPEAT INTEGER LBRACE exprs RBRACE"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = RepeatNode(p[2], p[4])
+    p[0] = at(RepeatNode(p[2], p[4]), p, 1)
+
+
+def p_expression_quota(p):
+    """expression : QUOTA INTEGER LBRACE quotas RBRACE
+                  | QUOTA INTEGER FROM val LBRACE quotas RBRACE"""
+    if len(p) == 6:
+        p[0] = at(QuotaNode(p[2], at(AnyNode(), p, 1), p[4]), p, 1)
+    else:
+        p[0] = at(QuotaNode(p[2], p[4], p[6]), p, 1)
+
+
+def p_quotas(p):
+    """quotas : quota
+              | quotas quota"""
+    if len(p) == 3:
+        p[0] = p[1] + [p[2]]
+    else:
+        p[0] = [p[1]]
+
+
+def p_quota(p):
+    """quota : BOUND INTEGER WHERE prop"""
+    p[0] = (p[1], p[2], p[4])
 
 
 def p_assign_expression(p):
     """expression : ID ASSIGN val
                   | ID ASSIGN val_list"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = AssignNode(update_variable, p[3], p[1])
+    p[0] = at(AssignNode(update_variable, p[3], p[1]), p, 1)
 
 
 def p_extract_expression(p):
     """expression : val EXTRACT ID"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = AssignNode(random_assign, p[1], p[3])
+    p[0] = at(AssignNode(random_assign, p[1], p[3]), p, 1)
 
 
 def p_split_expression(p):
     """expression : val SPLIT id_list"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = AssignNode(split_list, p[1], *p[3])
+    p[0] = at(AssignNode(split_list, p[1], *p[3]), p, 1)
 
 
 def p_add_expression(p):
     """expression : ADD LPAREN val RPAREN"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = AddNode(p[3])
+    p[0] = at(AddNode(p[3]), p, 1)
 
 
 def p_val_list(p):
     """val_list : LBRACKET val_listp RBRACKET"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = ListNode(p[2])
+    p[0] = at(ListNode(p[2]), p, 1)
 
 
 def p_val_id(p):
     """val : ID"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = IdNode(p[1])
+    p[0] = at(IdNode(p[1]), p, 1)
 
 
 def p_val_any(p):
     """val : ANY"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = AnyNode()
+    p[0] = at(AnyNode(), p, 1)
 
 
 def p_val_constant(p):
     """val : STRING
            | INTEGER"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = ConstantNode(p[1])
+    p[0] = at(ConstantNode(p[1]), p, 1)
 
 
 def p_val_function(p):
     """val : FUNCTION LPAREN val_listp RPAREN"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = FunctionNode(p[1], p[3])
+    p[0] = at(FunctionNode(p[1], p[3]), p, 1)
 
 
 def p_val_comprehension(p):
     """val : LBRACKET val WHERE prop RBRACKET"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = ComprehensionNode(p[2], p[4])
+    p[0] = at(ComprehensionNode(p[2], p[4]), p, 1)
 
 
 def p_prop(p):
     """prop : PROPOSITION LPAREN val_listp RPAREN"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = PropositionNode(p[1], *p[3])
+    p[0] = at(PropositionNode(p[1], *p[3]), p, 1)
 
 
 def p_prop_nested(p):
     """prop : LPAREN prop RPAREN"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = PropositionNode('Id', p[2])
+    p[0] = at(PropositionNode('Id', p[2]), p, 1)
 
 
 def p_prop_not(p):
     """prop : NOT prop"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = PropositionNode('Not', p[2])
+    p[0] = at(PropositionNode('Not', p[2]), p, 1)
 
 
 def p_prop_or(p):
     """prop : prop OR prop"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = PropositionNode('Or', p[1], p[3])
+    p[0] = at(PropositionNode('Or', p[1], p[3]), p, 2)
 
 
 def p_prop_and(p):
     """prop : prop AND prop"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
-    p[0] = PropositionNode('And', p[1], p[3])
+    p[0] = at(PropositionNode('And', p[1], p[3]), p, 2)
 
 
 def p_separator_list(p):
@@ -583,8 +1725,6 @@ def p_separator_list(p):
                | id_list COMMA ID
        val_listp : val
                  | val_listp COMMA val"""
-    if DEBUG:
-        print(inspect.stack()[0][3])
     if len(p) == 4:
         p[0] = p[1] + [p[3]]
     else:
@@ -598,7 +1738,12 @@ reserved = {
     'Any': 'ANY',
     'Repeat': 'REPEAT',
     'or': 'OR',
-    'not': 'NOT'
+    'not': 'NOT',
+    'Quota': 'QUOTA',
+    'from': 'FROM',
+    'AtLeast': 'BOUND',
+    'AtMost': 'BOUND',
+    'Exactly': 'BOUND'
 }
 for function in functions:
     reserved[function] = 'FUNCTION'
@@ -629,24 +1774,18 @@ precedence = (
 
 @TOKEN(r'[a-zA-Z]+:')
 def t_RARITY_NAME(tok):
-    if DEBUG:
-        print(inspect.stack()[0][3], tok)
     tok.value = tok.value[:-1]
     return tok
 
 
 @TOKEN(r"('[^']*')|" + '("[^"]*")')
 def t_STRING(tok):
-    if DEBUG:
-        print(inspect.stack()[0][3], tok)
     tok.value = tok.value[1:-1]
     return tok
 
 
 @TOKEN(r'[0-9]+')
 def t_INTEGER(tok):
-    if DEBUG:
-        print(inspect.stack()[0][3], tok)
     tok.value = int(tok.value)
     return tok
 
@@ -655,8 +1794,6 @@ def t_INTEGER(tok):
 def t_ID(tok):
     if tok.value in reserved:
         tok.type = reserved[tok.value]
-    if DEBUG:
-        print(inspect.stack()[0][3], tok)
     return tok
 
 
@@ -681,41 +1818,171 @@ t_ignore_COMMENT = r'/\*.*\*/'
 t_ignore = ' \t'
 
 
-def find_column(token):
-    last_cr = token.lexer.lexdata.rfind('\n', 0, token.lexpos)
-    if last_cr < 0:
-        last_cr = 0
-    column = (token.lexpos - last_cr) + 1
-    return column
+def find_column(data, lexpos):
+    return lexpos - data.rfind('\n', 0, lexpos)
+
+
+def token_position(t):
+    return (t.lexer.filename, t.lineno, find_column(t.lexer.lexdata, t.lexpos))
 
 
 # Error handling rule
 def t_error(t):
-    pass
-    # print("Illegal character '%s'" % t.value[0])
-    t.lexer.skip(1)
+    raise DefError("Illegal character '{}'".format(t.value[0]), token_position(t))
 
 
 def p_error(t):
     if t:
-        print("Syntax error at token", t.type, "line", t.lineno, find_column(t))
-        # Just discard the token and tell the parser it's okay.
-        # parser.errok()
-    else:
-        print("Syntax error at EOF")
+        raise DefError("Syntax error at '{}'".format(t.value), token_position(t))
+    raise DefError('Unexpected end of file', (lexer.filename, lexer.lineno, 1))
 
 
+# The lexer and parser tables are generated once into lextab.py and parsetab.py next to this file
+# and loaded from there afterwards. The parser tables are regenerated if the grammar changes, but
+# lextab.py is trusted as is and has to be deleted after changing the tokens.
+table_dir = os.path.dirname(os.path.abspath(__file__))
+
 # Build the lexer
-lexer = lex.lex()
+lexer = lex.lex(optimize=1, lextab='lextab', outputdir=table_dir)
+# Named in errors, create_tree sets it to the file being parsed
+lexer.filename = '<string>'
 
 # Build the parser
-parser = yacc.yacc()
+parser = yacc.yacc(tabmodule='parsetab', outputdir=table_dir, debug=False)
+
+# Loaded trees are cached under the user's cache directory
+tree_cache = TreeCache()
 
 
 # ------- Input function
-def create_tree(in_file):
+def share_cards(tree, path):
+    """
+    Write the cards of a loaded tree to a card database at path and read them from it instead.
+
+    Trees sent to worker processes then map the file rather than carrying a copy of every card.
+    """
+    files = {}
+    for rarity in tree.lst:
+        for fname, cards in rarity.file_list.items():
+            files.setdefault('{}/{}'.format(rarity.name, fname), cards)
+        files.setdefault(rarity.name, rarity.members)
+    tree.cards = write_database(tree.cards, files.items(), path)
+    for rarity in tree.lst:
+        rarity.share(tree.cards)
+
+
+def create_tree(in_file, cache=tree_cache):
+    """
+    Parse a .def file and load the cards of its rarities.
+
+    Raises DefError with the file, line and column of the first syntax error, call with the wrong
+    number of arguments, name used before it is assigned or rarity without a directory.
+
+    The loaded tree is kept in cache and reused until the .def file or any of the .dec files change,
+    with its cards in a card database next to it. Pass cache=None to always read everything and keep
+    the cards in memory.
+    """
     in_contents = ''
     with open(in_file) as in_file_obj:
         in_contents = in_file_obj.read()
-    result = parser.parse(in_contents, lexer=lexer, debug=DEBUG)
+    # Nodes keep the name of their file for errors, so it is part of the key
+    cache_key = '{}\0{}'.format(in_file, in_contents)
+    if cache is not None:
+        result = cache.get(cache_key)
+        if result is not None:
+            return result
+    lexer.filename = in_file
+    lexer.lineno = 1
+    result = parser.parse(in_contents, lexer=lexer, tracking=True)
+    if result is None:
+        raise DefError('No rarities defined', (in_file, 1, 1))
+    validate(result, {'pack', 'FileNames'})
+    hoist_invariants(result)
+    for rarity in result.lst:
+        if not os.path.isdir(rarity.name):
+            raise DefError("No directory '{}' for rarity {}".format(rarity.name, rarity.name),
+                           rarity.pos)
+    files = manifest(result)
+    result.cards = CardTable()
+    for rarity in result.lst:
+        rarity.load(result.cards)
+    # Resolve uncached cards concurrently before any pack is evaluated
+    prefetch_color_identities(result.cards.lines)
+    # Colors fetched for new cards were appended to the color cache, and the tree has them already
+    colors_path = colors_source()
+    if colors_path is not None:
+        files[colors_path] = file_entry(colors_path)
+    result.cards.index_colors()
+    if cache is not None:
+        try:
+            cache.make_dir()
+            share_cards(result, cache.cards_path(cache_key))
+        except OSError:
+            # Not worth failing for, the cards stay in memory
+            pass
+        cache.put(cache_key, files, result)
     return result
+
+
+class Scope():
+    """
+    The frame slot of every variable name used by a compiled tree.
+
+    Slots the evaluator keeps for itself are named with a leading $, which no name in a def file can
+    start with, so a def cannot assign over them. Nodes compile their children through compile,
+    which wraps every closure in the profiler's timing when there is one.
+    """
+    def __init__(self, profiler=None):
+        self.slots = {}
+        self.profiler = profiler
+
+    def slot(self, name):
+        if name not in self.slots:
+            self.slots[name] = len(self.slots)
+        return self.slots[name]
+
+    def compile(self, node):
+        run = node.compile(self)
+        if self.profiler is not None:
+            run = self.profiler.wrap(node, run)
+        return run
+
+
+class CompiledTree():
+    """
+    A tree lowered into closures by compile_tree, with every variable in a slot of one frame.
+
+    Each Context gets its own frame, which lives as long as the context just as its variable frames
+    do for the interpreter, so a fixed seed produces the same packs either way.
+    """
+    def __init__(self, tree, profiler=None):
+        self.tree = tree
+        self.cards = tree.cards
+        self.scope = Scope(profiler)
+        self.pack_slot = self.scope.slot('pack')
+        self.pack_cards_slot = self.scope.slot('$pack_cards')
+        self.context_slot = self.scope.slot('$context')
+        self.run = self.scope.compile(tree)
+
+    def __str__(self):
+        return str(self.tree)
+
+    def eval(self, pack, ctx=None):
+        if ctx is None:
+            ctx = self.tree.default_context()
+        frame = ctx.slot_frames.get(self)
+        if frame is None:
+            frame = ctx.slot_frames[self] = [unset] * len(self.scope.slots)
+            frame[self.context_slot] = ctx
+        ctx.start_pack(pack)
+        frame[self.pack_slot] = pack
+        frame[self.pack_cards_slot] = ctx.pack_cards
+        self.run(frame)
+        return True
+
+
+def compile_tree(tree, profiler=None):
+    """
+    Compile a tree from create_tree for fast repeated evaluation, timing every node with profiler.
+    """
+    return CompiledTree(tree, profiler)
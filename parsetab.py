@@ -0,0 +1,63 @@
+
+# parsetab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = 'leftANDORrightNOTADD AND ANY ASSIGN BOUND COMMA EXTRACT FROM FUNCTION ID INTEGER LBRACE LBRACKET LPAREN NOT OR PROPOSITION QUOTA RARITY_NAME RBRACE RBRACKET REPEAT RPAREN SPLIT STRING WHEREstart : rarity_listrarity_list : rarity\n                   | rarity_list rarityexprs : expression\n             | exprs expressionrarity : RARITY_NAME INTEGER exprsexpression : REPEAT INTEGER LBRACE exprs RBRACEexpression : QUOTA INTEGER LBRACE quotas RBRACE\n                  | QUOTA INTEGER FROM val LBRACE quotas RBRACEquotas : quota\n              | quotas quotaquota : BOUND INTEGER WHERE propexpression : ID ASSIGN val\n                  | ID ASSIGN val_listexpression : val EXTRACT IDexpression : val SPLIT id_listexpression : ADD LPAREN val RPARENval_list : LBRACKET val_listp RBRACKETval : IDval : ANYval : STRING\n           | INTEGERval : FUNCTION LPAREN val_listp RPARENval : LBRACKET val WHERE prop RBRACKETprop : PROPOSITION LPAREN val_listp RPARENprop : LPAREN prop RPARENprop : NOT propprop : prop OR propprop : prop AND propid_list : ID\n               | id_list COMMA ID\n       val_listp : val\n                 | val_listp COMMA val'
+    
+_lr_action_items = {'RARITY_NAME':([0,2,3,5,7,8,9,15,16,19,28,32,33,34,35,36,50,51,57,58,62,63,65,78,],[4,4,-2,-3,-22,-6,-4,-20,-21,-5,-19,-15,-16,-30,-13,-14,-17,-23,-7,-8,-31,-18,-24,-9,]),'$end':([1,2,3,5,7,8,9,15,16,19,28,32,33,34,35,36,50,51,57,58,62,63,65,78,],[0,-1,-2,-3,-22,-6,-4,-20,-21,-5,-19,-15,-16,-30,-13,-14,-17,-23,-7,-8,-31,-18,-24,-9,]),'INTEGER':([4,6,7,8,9,10,11,15,16,18,19,24,25,26,28,29,31,32,33,34,35,36,37,42,45,50,51,52,57,58,62,63,65,68,78,],[6,7,-22,7,-4,20,21,-20,-21,7,-5,7,7,7,-19,7,7,-15,-16,-30,-13,-14,7,7,60,-17,-23,7,-7,-8,-31,-18,-24,7,-9,]),'REPEAT':([6,7,8,9,15,16,19,28,29,32,33,34,35,36,42,50,51,57,58,62,63,65,78,],[10,-22,10,-4,-20,-21,-5,-19,10,-15,-16,-30,-13,-14,10,-17,-23,-7,-8,-31,-18,-24,-9,]),'QUOTA':([6,7,8,9,15,16,19,28,29,32,33,34,35,36,42,50,51,57,58,62,63,65,78,],[11,-22,11,-4,-20,-21,-5,-19,11,-15,-16,-30,-13,-14,11,-17,-23,-7,-8,-31,-18,-24,-9,]),'ID':([6,7,8,9,15,16,18,19,22,23,24,25,26,28,29,31,32,33,34,35,36,37,42,47,50,51,52,57,58,62,63,65,68,78,],[13,-22,13,-4,-20,-21,28,-5,32,34,28,28,28,-19,13,28,-15,-16,-30,-13,-14,28,13,62,-17,-23,28,-7,-8,-31,-18,-24,28,-9,]),'ADD':([6,7,8,9,15,16,19,28,29,32,33,34,35,36,42,50,51,57,58,62,63,65,78,],[14,-22,14,-4,-20,-21,-5,-19,14,-15,-16,-30,-13,-14,14,-17,-23,-7,-8,-31,-18,-24,-9,]),'ANY':([6,7,8,9,15,16,18,19,24,25,26,28,29,31,32,33,34,35,36,37,42,50,51,52,57,58,62,63,65,68,78,],[15,-22,15,-4,-20,-21,15,-5,15,15,15,-19,15,15,-15,-16,-30,-13,-14,15,15,-17,-23,15,-7,-8,-31,-18,-24,15,-9,]),'STRING':([6,7,8,9,15,16,18,19,24,25,26,28,29,31,32,33,34,35,36,37,42,50,51,52,57,58,62,63,65,68,78,],[16,-22,16,-4,-20,-21,16,-5,16,16,16,-19,16,16,-15,-16,-30,-13,-14,16,16,-17,-23,16,-7,-8,-31,-18,-24,16,-9,]),'FUNCTION':([6,7,8,9,15,16,18,19,24,25,26,28,29,31,32,33,34,35,36,37,42,50,51,52,57,58,62,63,65,68,78,],[17,-22,17,-4,-20,-21,17,-5,17,17,17,-19,17,17,-15,-16,-30,-13,-14,17,17,-17,-23,17,-7,-8,-31,-18,-24,17,-9,]),'LBRACKET':([6,7,8,9,15,16,18,19,24,25,26,28,29,31,32,33,34,35,36,37,42,50,51,52,57,58,62,63,65,68,78,],[18,-22,18,-4,-20,-21,18,-5,37,18,18,-19,18,18,-15,-16,-30,-13,-14,18,18,-17,-23,18,-7,-8,-31,-18,-24,18,-9,]),'EXTRACT':([7,12,13,15,16,51,65,],[-22,22,-19,-20,-21,-23,-24,]),'SPLIT':([7,12,13,15,16,51,65,],[-22,23,-19,-20,-21,-23,-24,]),'WHERE':([7,15,16,27,28,48,51,60,65,],[-22,-20,-21,41,-19,41,-23,71,-24,]),'RBRACE':([7,9,15,16,19,28,32,33,34,35,36,42,43,44,50,51,57,58,59,62,63,65,70,72,73,74,76,77,78,79,],[-22,-4,-20,-21,-5,-19,-15,-16,-30,-13,-14,57,58,-10,-17,-23,-7,-8,-11,-31,-18,-24,-27,78,-28,-29,-26,-12,-9,-25,]),'RPAREN':([7,15,16,28,38,39,40,51,64,65,69,70,73,74,75,76,79,],[-22,-20,-21,-19,50,51,-32,-23,-33,-24,76,-27,-28,-29,79,-26,-25,]),'COMMA':([7,15,16,28,33,34,39,40,48,49,51,62,64,65,75,],[-22,-20,-21,-19,47,-30,52,-32,-32,52,-23,-31,-33,-24,52,]),'LBRACE':([7,15,16,20,21,28,46,51,65,],[-22,-20,-21,29,30,-19,61,-23,-24,]),'RBRACKET':([7,15,16,28,48,49,51,53,64,65,70,73,74,76,79,],[-22,-20,-21,-19,-32,63,-23,65,-33,-24,-27,-28,-29,-26,-25,]),'ASSIGN':([13,],[24,]),'LPAREN':([14,17,41,54,55,56,66,67,71,],[25,26,55,68,55,55,55,55,55,]),'FROM':([21,],[31,]),'BOUND':([30,43,44,59,61,70,72,73,74,76,77,79,],[45,45,-10,-11,45,-27,45,-28,-29,-26,-12,-25,]),'PROPOSITION':([41,55,56,66,67,71,],[54,54,54,54,54,54,]),'NOT':([41,55,56,66,67,71,],[56,56,56,56,56,56,]),'OR':([53,69,70,73,74,76,77,79,],[66,66,-27,-28,-29,-26,66,-25,]),'AND':([53,69,70,73,74,76,77,79,],[67,67,-27,-28,-29,-26,67,-25,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'start':([0,],[1,]),'rarity_list':([0,],[2,]),'rarity':([0,2,],[3,5,]),'exprs':([6,29,],[8,42,]),'expression':([6,8,29,42,],[9,19,9,19,]),'val':([6,8,18,24,25,26,29,31,37,42,52,68,],[12,12,27,35,38,40,12,46,48,12,64,40,]),'id_list':([23,],[33,]),'val_list':([24,],[36,]),'val_listp':([26,37,68,],[39,49,75,]),'quotas':([30,61,],[43,72,]),'quota':([30,43,61,72,],[44,59,44,59,]),'prop':([41,55,56,66,67,71,],[53,69,70,73,74,77,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> start","S'",1,None,None,None),
+  ('start -> rarity_list','start',1,'p_start','parsertree.py',1075),
+  ('rarity_list -> rarity','rarity_list',1,'p_rarity_list','parsertree.py',1082),
+  ('rarity_list -> rarity_list rarity','rarity_list',2,'p_rarity_list','parsertree.py',1083),
+  ('exprs -> expression','exprs',1,'p_exprs_list','parsertree.py',1093),
+  ('exprs -> exprs expression','exprs',2,'p_exprs_list','parsertree.py',1094),
+  ('rarity -> RARITY_NAME INTEGER exprs','rarity',3,'p_rarity','parsertree.py',1104),
+  ('expression -> REPEAT INTEGER LBRACE exprs RBRACE','expression',5,'p_expression_repeat','parsertree.py',1111),
+  ('expression -> QUOTA INTEGER LBRACE quotas RBRACE','expression',5,'p_expression_quota','parsertree.py',1118),
+  ('expression -> QUOTA INTEGER FROM val LBRACE quotas RBRACE','expression',7,'p_expression_quota','parsertree.py',1119),
+  ('quotas -> quota','quotas',1,'p_quotas','parsertree.py',1129),
+  ('quotas -> quotas quota','quotas',2,'p_quotas','parsertree.py',1130),
+  ('quota -> BOUND INTEGER WHERE prop','quota',4,'p_quota','parsertree.py',1140),
+  ('expression -> ID ASSIGN val','expression',3,'p_assign_expression','parsertree.py',1147),
+  ('expression -> ID ASSIGN val_list','expression',3,'p_assign_expression','parsertree.py',1148),
+  ('expression -> val EXTRACT ID','expression',3,'p_extract_expression','parsertree.py',1155),
+  ('expression -> val SPLIT id_list','expression',3,'p_split_expression','parsertree.py',1162),
+  ('expression -> ADD LPAREN val RPAREN','expression',4,'p_add_expression','parsertree.py',1169),
+  ('val_list -> LBRACKET val_listp RBRACKET','val_list',3,'p_val_list','parsertree.py',1176),
+  ('val -> ID','val',1,'p_val_id','parsertree.py',1183),
+  ('val -> ANY','val',1,'p_val_any','parsertree.py',1190),
+  ('val -> STRING','val',1,'p_val_constant','parsertree.py',1197),
+  ('val -> INTEGER','val',1,'p_val_constant','parsertree.py',1198),
+  ('val -> FUNCTION LPAREN val_listp RPAREN','val',4,'p_val_function','parsertree.py',1205),
+  ('val -> LBRACKET val WHERE prop RBRACKET','val',5,'p_val_comprehension','parsertree.py',1212),
+  ('prop -> PROPOSITION LPAREN val_listp RPAREN','prop',4,'p_prop','parsertree.py',1219),
+  ('prop -> LPAREN prop RPAREN','prop',3,'p_prop_nested','parsertree.py',1226),
+  ('prop -> NOT prop','prop',2,'p_prop_not','parsertree.py',1233),
+  ('prop -> prop OR prop','prop',3,'p_prop_or','parsertree.py',1240),
+  ('prop -> prop AND prop','prop',3,'p_prop_and','parsertree.py',1247),
+  ('id_list -> ID','id_list',1,'p_separator_list','parsertree.py',1254),
+  ('id_list -> id_list COMMA ID','id_list',3,'p_separator_list','parsertree.py',1255),
+  ('val_listp -> val','val_listp',1,'p_separator_list','parsertree.py',1256),
+  ('val_listp -> val_listp COMMA val','val_listp',3,'p_separator_list','parsertree.py',1257),
+]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Per node profiling of compiled trees.
+
+Pass a Profiler to compile_tree and every node's closure is timed. The report is the usual
+str(tree) with each node's line prefixed by its figures, and the timings can also be written as
+folded stacks for flamegraph.pl or speedscope.
+"""
+import sys
+import time
+
+from collections import defaultdict
+
+import gatherer
+import parsertree
+
+from parsertree import CardPool, ComprehensionNode
+
+
+class NodeStats():
+    """
+    Calls, time with and without children, and the total length of the lists a node returned.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.items = 0
+        self.sized = 0
+
+    def mean_items(self):
+        return self.items / self.sized if self.sized else 0
+
+
+def node_label(node):
+    """
+    The first line of a node's rendering, without its children, as a flamegraph frame.
+    """
+    return str(node).split('\n')[0].replace(';', ',')
+
+
+class Profiler():
+    def __init__(self):
+        self.stats = {}
+        self.folded = defaultdict(float)
+        self.path = []
+        self.children = []
+        self.color_cache = (gatherer.color_store.hits, gatherer.color_store.misses)
+        self.tree_cache = (parsertree.tree_cache.hits, parsertree.tree_cache.misses)
+
+    def wrap(self, node, run):
+        """
+        Time a node's compiled closure, charging its time to the node and the current stack.
+        """
+        stats = self.stats.setdefault(node, NodeStats())
+        label = node_label(node)
+        path = self.path
+        children = self.children
+
+        def timed(frame):
+            stats.calls += 1
+            path.append(label)
+            children.append(0.0)
+            start = time.perf_counter()
+            try:
+                res = run(frame)
+            finally:
+                elapsed = time.perf_counter() - start
+                own = elapsed - children.pop()
+                self.folded[tuple(path)] += own
+                path.pop()
+                if children:
+                    children[-1] += elapsed
+                stats.total += elapsed
+                stats.own += own
+            if isinstance(res, (list, tuple, set, frozenset, CardPool)):
+                stats.items += len(res)
+                stats.sized += 1
+            return res
+        return timed
+
+    def annotation(self, node):
+        stats = self.stats.get(node)
+        if stats is None or stats.calls == 0:
+            return '[{:>37}] '.format('not run')
+        res = '[{:>8} calls {:>9.2f}ms {:>8.2f}ms self'.format(stats.calls, stats.total * 1000,
+                                                               stats.own * 1000)
+        if isinstance(node, ComprehensionNode) and node.source in self.stats:
+            res += ', kept {:.1f} of {:.1f}'.format(stats.mean_items(),
+                                                    self.stats[node.source].mean_items())
+        elif stats.sized:
+            res += ', {:.1f} items'.format(stats.mean_items())
+        return res + '] '
+
+    def report(self, tree, out=sys.stderr):
+        """
+        Write the tree annotated with every node's figures, followed by the cache hit rates.
+        """
+        parsertree.annotator = self.annotation
+        try:
+            out.write(str(tree) + '\n')
+        finally:
+            parsertree.annotator = None
+        for name, store, start in (('Color cache', gatherer.color_store, self.color_cache),
+                                   ('Tree cache', parsertree.tree_cache, self.tree_cache)):
+            hits = store.hits - start[0]
+            misses = store.misses - start[1]
+            rate = 100 * hits / (hits + misses) if hits + misses else 0
+            out.write('{}: {} hits, {} misses ({:.1f}% hit rate)\n'.format(name, hits, misses,
+                                                                             rate))
+
+    def write_folded(self, path):
+        """
+        Write the time spent in every stack of nodes, in microseconds, as folded stacks.
+        """
+        with open(path, 'w') as out:
+            for stack, seconds in sorted(self.folded.items()):
+                out.write('{} {}\n'.format(';'.join(stack), int(round(seconds * 1e6))))
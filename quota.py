@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Drawing a set of cards that meets bounds on how many of them match each of a few filters.
+"""
+import random
+
+from collections import defaultdict
+
+
+class QuotaSearch():
+    """
+    Finds how to meet the bounds with the cards that are left.
+
+    Cards are grouped by which filters they match, so the search only decides how many cards to
+    take from each group. There are at most 2^k groups for k filters. Searches are memoized per
+    group on what is still needed, and a group's memo stays valid until the count of it or of an
+    earlier group changes.
+    """
+    def __init__(self, signatures, caps, n_bounds):
+        self.signatures = signatures
+        self.caps = caps
+        self.n_bounds = n_bounds
+        self.bits = [[j for j in range(n_bounds) if sig >> j & 1] for sig in signatures]
+        self.memo = [{} for _ in caps]
+        self.suffix = None
+
+    def set_cap(self, i, cap):
+        self.caps[i] = cap
+        for memo in self.memo[:i + 1]:
+            memo.clear()
+        self.suffix = None
+
+    def plan(self, n, lows, highs):
+        """
+        How many cards to take from each group to meet the bounds, or None if it cannot be done.
+        """
+        lows = tuple(max(low, 0) for low in lows)
+        highs = tuple(min(high, n) for high in highs)
+        if min(highs, default=0) < 0:
+            return None
+        if not any(lows) and min(highs, default=n) >= n:
+            # Nothing left to meet, so any n cards will do
+            res = []
+            for cap in self.caps:
+                res.append(min(cap, n - sum(res)))
+            return res if sum(res) == n else None
+        if self.suffix is None:
+            # Cards left in groups i and later, in total and for each filter
+            self.suffix = [[0] * (self.n_bounds + 1) for _ in range(len(self.caps) + 1)]
+            for i in range(len(self.caps) - 1, -1, -1):
+                self.suffix[i] = list(self.suffix[i + 1])
+                self.suffix[i][-1] += self.caps[i]
+                for j in range(self.n_bounds):
+                    if self.signatures[i] >> j & 1:
+                        self.suffix[i][j] += self.caps[i]
+        if self.suffix[0][-1] < n or any(low > self.suffix[0][j] for j, low in enumerate(lows)):
+            return None
+        res = self.search(0, n, lows, highs)
+        return None if res is None else list(res)
+
+    def search(self, i, n, lows, highs):
+        if i == len(self.caps):
+            return () if n == 0 and not any(lows) else None
+        key = (n, lows, highs)
+        memo = self.memo[i]
+        if key not in memo:
+            res = None
+            bits = self.bits[i]
+            rest = self.suffix[i + 1]
+            # Take few enough to stay under every upper bound, and enough that the groups after
+            # this one can make up the rest of n and of every lower bound
+            most = min([self.caps[i], n] + [highs[j] for j in bits])
+            least = max([0, n - rest[-1]] + [lows[j] - rest[j] for j in bits])
+            if all(low <= rest[j] for j, low in enumerate(lows) if j not in bits):
+                for take in range(most, least - 1, -1):
+                    left = n - take
+                    next_lows = list(lows)
+                    next_highs = list(highs)
+                    for j in bits:
+                        next_lows[j] = max(next_lows[j] - take, 0)
+                        next_highs[j] -= take
+                    found = self.search(i + 1, left, tuple(next_lows),
+                                        tuple(min(h, left) for h in next_highs))
+                    if found is not None:
+                        res = (take,) + found
+                        break
+            memo[key] = res
+        return memo[key]
+
+
+def shift(sig, take, lows, highs):
+    """
+    The bounds left after taking take cards from a group with signature sig.
+    """
+    next_lows = tuple(max(low - take, 0) if sig >> j & 1 else low for j, low in enumerate(lows))
+    next_highs = tuple(high - take if sig >> j & 1 else high for j, high in enumerate(highs))
+    return next_lows, next_highs
+
+
+def sample_quota(cards, weights, n, bounds, rng=random):
+    """
+    Draw n distinct cards so that for every (low, high, members) in bounds between low and high of
+    them are in members.
+
+    Cards are drawn one at a time with probability proportional to weights[cd], only from the
+    groups that leave the remaining bounds satisfiable, so the draw never runs into a dead end. If
+    no set of cards meets the bounds ValueError is raised before anything is drawn.
+    """
+    groups = defaultdict(list)
+    for cd in cards:
+        if weights[cd] > 0:
+            sig = sum(1 << j for j, (_, _, members) in enumerate(bounds) if cd in members)
+            groups[sig].append(cd)
+    signatures = sorted(groups)
+    cards_by_group = [groups[sig] for sig in signatures]
+    caps = [len(group) for group in cards_by_group]
+    lows = tuple(low for low, _, _ in bounds)
+    highs = tuple(high for _, high, _ in bounds)
+    search = QuotaSearch(signatures, caps, len(bounds))
+    plan = search.plan(n, lows, highs)
+    if plan is None:
+        raise ValueError('No {} cards meet the quotas'.format(n))
+
+    res = []
+    for left in range(n - 1, -1, -1):
+        options = []
+        for i, sig in enumerate(signatures):
+            if caps[i] == 0:
+                continue
+            if plan[i] > 0:
+                # The plan still works with this card taken out of it
+                options.append(i)
+                continue
+            search.set_cap(i, caps[i] - 1)
+            next_lows, next_highs = shift(sig, 1, lows, highs)
+            if search.plan(left, next_lows, next_highs) is not None:
+                options.append(i)
+            search.set_cap(i, caps[i] + 1)
+        total = sum(weights[cd] for i in options for cd in cards_by_group[i])
+        remaining = rng.randrange(total)
+        for i in options:
+            for pos, cd in enumerate(cards_by_group[i]):
+                remaining -= weights[cd]
+                if remaining < 0:
+                    break
+            if remaining < 0:
+                break
+        cards_by_group[i].pop(pos)
+        search.set_cap(i, caps[i] - 1)
+        lows, highs = shift(signatures[i], 1, lows, highs)
+        res.append(cd)
+        if plan[i] > 0:
+            plan[i] -= 1
+        elif left > 0:
+            plan = search.plan(left, lows, highs)
+    return res
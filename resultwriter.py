@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Writing packbuilder results so a crash never leaves a half-written tree where the results should be.
+
+Results are either a directory, written into a staging directory next to it through a pool of
+threads and renamed into place once complete, or a single tar, zip or JSON lines archive written to
+a temporary file and renamed over the old one. The previous results are kept with a .bak suffix.
+"""
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+archive_kinds = ['tar', 'zip', 'jsonl']
+
+
+def write_file(path, text):
+    with open(path, 'w') as out:
+        out.write(text)
+
+
+class StagedDirectory():
+    """
+    Results written to files in a staging directory and swapped in for dest_dir by commit.
+
+    Whole files are written by threads, at most a few per thread waiting at a time, while appended
+    files are opened for each part in the calling thread so their parts stay in order without a
+    descriptor held per file. With a single thread everything is written in the calling thread,
+    which is quickest on a local disk.
+    """
+    def __init__(self, dest_dir, threads=8):
+        self.dest_dir = os.path.normpath(dest_dir)
+        parent = os.path.dirname(self.dest_dir) or '.'
+        os.makedirs(parent, exist_ok=True)
+        prefix = '.{}.'.format(os.path.basename(self.dest_dir))
+        self.staging = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        # mkdtemp makes the directory private, the results should get the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.staging, 0o777 & ~umask)
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.pending = []
+        self.directories = set()
+
+    def staged_path(self, path):
+        res = os.path.join(self.staging, path)
+        directory = os.path.dirname(res)
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        return res
+
+    def write(self, path, text):
+        """
+        Write text to path, relative to the results, in the background.
+        """
+        if self.pool is None:
+            write_file(self.staged_path(path), text)
+            return
+        self.pending.append(self.pool.submit(write_file, self.staged_path(path), text))
+        if len(self.pending) > 4 * self.threads:
+            # Hold as little as possible in memory, and raise any error early
+            self.pending.pop(0).result()
+
+    def append(self, path, text):
+        with open(self.staged_path(path), 'a') as out:
+            out.write(text)
+
+    def finish(self):
+        try:
+            for future in self.pending:
+                future.result()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+
+    def commit(self):
+        """
+        Wait for every write, then move the old results to .bak and the new ones into place.
+        """
+        self.finish()
+        backup = self.dest_dir + '.bak'
+        old_backup = None
+        if os.path.lexists(self.dest_dir):
+            if os.path.lexists(backup):
+                # Renamed out of the way first so the swap is not held up deleting it
+                old_backup = self.staging + '.old'
+                os.rename(backup, old_backup)
+            os.rename(self.dest_dir, backup)
+        os.rename(self.staging, self.dest_dir)
+        if old_backup is not None:
+            shutil.rmtree(old_backup)
+
+    def abort(self):
+        try:
+            self.finish()
+        finally:
+            shutil.rmtree(self.staging, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class Archive():
+    """
+    Results written as the members of one tar, zip or JSON lines file at dest, replaced by commit.
+
+    Each JSON line is an object with the path and contents of one file. The parts of appended files
+    are spooled to one temporary file and added after everything else.
+    """
+    def __init__(self, dest, kind):
+        self.dest = dest
+        self.kind = kind
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(dest)),
+                                             dir=os.path.dirname(dest) or '.')
+        os.close(fd)
+        if kind == 'tar':
+            self.out = tarfile.open(self.tmp_path, 'w')
+        elif kind == 'zip':
+            self.out = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED)
+        elif kind == 'jsonl':
+            self.out = open(self.tmp_path, 'w')
+        else:
+            raise ValueError('Unknown archive kind {}'.format(kind))
+        self.spool = None
+        # Path to the (offset, size) of each of its parts in the spool
+        self.appending = {}
+
+    def write(self, path, text):
+        if self.kind == 'tar':
+            data = text.encode()
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            self.out.addfile(info, io.BytesIO(data))
+        elif self.kind == 'zip':
+            self.out.writestr(path, text)
+        else:
+            self.out.write(json.dumps({'path': path, 'contents': text}) + '\n')
+
+    def append(self, path, text):
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+        data = text.encode()
+        self.appending.setdefault(path, []).append((self.spool.tell(), len(data)))
+        self.spool.write(data)
+
+    def finish(self):
+        try:
+            for path, parts in sorted(self.appending.items()):
+                data = []
+                for offset, size in parts:
+                    self.spool.seek(offset)
+                    data.append(self.spool.read(size))
+                self.write(path, b''.join(data).decode())
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+            self.out.close()
+
+    def commit(self):
+        """
+        Finish the archive and put it in place, keeping a link to the old one as .bak.
+        """
+        self.finish()
+        if os.path.exists(self.dest):
+            backup = self.dest + '.bak'
+            if os.path.lexists(backup):
+                os.unlink(backup)
+            try:
+                os.link(self.dest, backup)
+            except OSError:
+                shutil.copy2(self.dest, backup)
+        os.chmod(self.tmp_path, 0o644)
+        os.replace(self.tmp_path, self.dest)
+
+    def abort(self):
+        try:
+            self.finish()
+        finally:
+            os.unlink(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def open_results(dest_dir, archive=None, threads=8):
+    """
+    A writer for results at dest_dir, or at dest_dir with the archive kind as its extension.
+    """
+    if archive is None:
+        return StagedDirectory(dest_dir, threads)
+    return Archive('{}.{}'.format(os.path.normpath(dest_dir), archive), archive)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Serve packs over HTTP, keeping loaded trees in memory so a request only pays for building packs.
+
+Run with `./server.py [--port 8000]`, or `./server.py --socket packs.sock` for a Unix socket, from
+the directory holding the rarity directories. Then ask for packs with
+`curl 'localhost:8000/packs?def=standardpack.def&count=3&seed=1'` or POST the same fields as a JSON
+object. GET /status lists the loaded trees.
+"""
+import argparse
+import json
+import os
+import random
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from packbuilder import card_entry, part_context
+from parsertree import DefError, compile_tree, create_tree, tree_cache
+from treecache import file_stamp, is_fresh, manifest
+
+max_count = 10000
+
+
+class LoadedTree():
+    """
+    A def file's tree, compiled, with the stamps of everything it was built from.
+    """
+    def __init__(self, path):
+        self.def_stamp = file_stamp(path)
+        self.tree = create_tree(path, tree_cache)
+        self.files = manifest(self.tree)
+        self.compiled = compile_tree(self.tree)
+        self.requests = 0
+        self.packs = 0
+
+    def is_fresh(self, path):
+        try:
+            return file_stamp(path) == self.def_stamp and is_fresh(self.tree, self.files)
+        except OSError:
+            return False
+
+
+class TreeStore():
+    """
+    Loaded trees by def file, reloaded when the def file or one of its .dec files changes.
+
+    Def files are only read from under root. A loaded tree is checked for changes without holding
+    any lock, so requests do not wait on each other's checks. Reloading a def file holds its own
+    lock, so concurrent requests for it load it once, and the parse lock, as loading goes through
+    the module's one lexer and parser. Building packs needs no lock since all of its state is in
+    each request's Context, only counting them for the status does.
+    """
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self.trees = {}
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.parse_lock = threading.Lock()
+        self.loads = 0
+
+    def resolve(self, def_file):
+        path = os.path.realpath(os.path.join(self.root, def_file))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise PermissionError('{} is outside {}'.format(def_file, self.root))
+        if not os.path.isfile(path):
+            raise FileNotFoundError('No def file {}'.format(def_file))
+        return path
+
+    def get(self, def_file):
+        path = self.resolve(def_file)
+        with self.lock:
+            loaded = self.trees.get(path)
+            load_lock = self.load_locks.setdefault(path, threading.Lock())
+        if loaded is not None and loaded.is_fresh(path):
+            return loaded
+        with load_lock:
+            with self.lock:
+                current = self.trees.get(path)
+            if current is not loaded:
+                # Reloaded by another request while this one waited
+                return current
+            with self.parse_lock:
+                loaded = LoadedTree(path)
+            with self.lock:
+                self.trees[path] = loaded
+                self.loads += 1
+        return loaded
+
+    def count(self, loaded, packs):
+        """
+        Count a request for packs from a loaded tree in its status.
+        """
+        with self.lock:
+            loaded.requests += 1
+            loaded.packs += packs
+
+    def status(self):
+        with self.lock:
+            trees = {os.path.relpath(path, self.root): {'cards': len(loaded.tree.cards),
+                                                        'requests': loaded.requests,
+                                                        'packs': loaded.packs}
+                     for path, loaded in self.trees.items()}
+        return {'loads': self.loads, 'trees': trees}
+
+
+def build_packs(loaded, count, seed):
+    """
+    Build count packs from one full cube, the same ones packbuilder builds from the seed with a
+    single worker.
+    """
+    ctx = part_context(seed, 0)
+    packs = []
+    for _ in range(count):
+        pack = []
+        loaded.compiled.eval(pack, ctx)
+        packs.append(loaded.tree.cards.dec_lines(pack))
+    return packs
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def pack_request(params):
+    """
+    The def file, count, seed and format asked for, checked.
+    """
+    def_file = params.get('def')
+    if not isinstance(def_file, str) or def_file == '':
+        raise RequestError(400, 'Missing def')
+    try:
+        count = int(params.get('count', 1))
+    except (TypeError, ValueError):
+        raise RequestError(400, 'count must be a whole number')
+    if not 0 < count <= max_count:
+        raise RequestError(400, 'count must be between 1 and {}'.format(max_count))
+    seed = params.get('seed')
+    if seed is None:
+        seed = random.getrandbits(64)
+    out_format = params.get('format', 'json')
+    if out_format not in ('json', 'dec'):
+        raise RequestError(400, 'format must be json or dec')
+    return def_file, count, str(seed), out_format
+
+
+class PackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/packs':
+            self.answer_packs({key: values[-1] for key, values in parse_qs(url.query).items()})
+        elif url.path == '/status':
+            self.send_json(200, self.server.store.status())
+        else:
+            self.send_json(404, {'error': 'Unknown path {}'.format(url.path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/packs':
+            self.send_json(404, {'error': 'Unknown path {}'.format(url.path)})
+            return
+        try:
+            params = json.loads(body or b'{}')
+        except ValueError:
+            params = None
+        if not isinstance(params, dict):
+            self.send_json(400, {'error': 'The body must be a JSON object'})
+            return
+        self.answer_packs(params)
+
+    def answer_packs(self, params):
+        start = time.perf_counter()
+        try:
+            def_file, count, seed, out_format = pack_request(params)
+            loaded = self.server.store.get(def_file)
+            packs = build_packs(loaded, count, seed)
+            self.server.store.count(loaded, count)
+        except RequestError as e:
+            self.send_json(e.status, {'error': str(e)})
+            return
+        except PermissionError as e:
+            self.send_json(403, {'error': str(e)})
+            return
+        except FileNotFoundError as e:
+            self.send_json(404, {'error': str(e)})
+            return
+        except DefError as e:
+            self.send_json(422, {'error': str(e)})
+            return
+        except Exception as e:
+            # Errors while generating, like a statement failing at runtime, still get an answer
+            self.log_error('Error building packs: %s', e)
+            self.send_json(500, {'error': str(e)})
+            return
+        if out_format == 'dec':
+            packs = [''.join(pack) for pack in packs]
+        else:
+            packs = [[card_entry(cd) for cd in pack] for pack in packs]
+        self.send_json(200, {'def': def_file, 'seed': seed, 'packs': packs,
+                             'ms': (time.perf_counter() - start) * 1000})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class TCPPackHandler(PackHandler):
+    # Headers and body are separate writes, which Nagle's algorithm holds up on kept alive
+    # connections
+    disable_nagle_algorithm = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(store, host='127.0.0.1', port=8000, socket_path=None, quiet=False):
+    """
+    An HTTP server for packs from store on host and port, or on a Unix socket at socket_path.
+    """
+    if socket_path is None:
+        server = ThreadingHTTPServer((host, port), TCPPackHandler)
+    else:
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            # Left behind by a server that did not shut down cleanly
+            os.unlink(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, PackHandler)
+    server.store = store
+    server.quiet = quiet
+    return server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8000)
+    arg_parser.add_argument('--socket', default=None,
+                            help='Listen on a Unix socket at this path instead')
+    arg_parser.add_argument('--preload', nargs='*', default=[],
+                            help='Def files to load before serving')
+    arg_parser.add_argument('--quiet', action='store_true', help='Do not log every request')
+    args = arg_parser.parse_args()
+
+    store = TreeStore(os.getcwd())
+    try:
+        for def_file in args.preload:
+            store.get(def_file)
+    except (DefError, OSError) as e:
+        sys.exit(str(e))
+    server = make_server(store, args.host, args.port, args.socket, args.quiet)
+    address = args.socket or 'http://{}:{}'.format(args.host, args.port)
+    print('Serving packs on {}'.format(address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None:
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
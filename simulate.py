@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Evaluate a def file many times and report how its packs turn out, without writing any .dec files.
+
+Every run starts from a full cube and builds packs until it has made packs_per_run of them or one
+fails. Statistics are kept as running counters and histograms, so memory does not grow with the
+number of packs.
+"""
+import argparse
+import json
+import random
+import sys
+
+from array import array
+from collections import Counter
+
+from cardtable import mask_colors
+from gatherer import colors
+from parsertree import AnyNode, AssignNode, ComprehensionNode, ConstantNode, Context, DefError
+from parsertree import FunctionNode, HoistNode, IdNode, QuotaNode, RepeatNode, StatementError
+from parsertree import compile_tree, create_tree, random_assign
+
+
+def describe(node):
+    """
+    A one line description of a value in a def file.
+    """
+    if isinstance(node, AnyNode):
+        return 'Any'
+    if isinstance(node, HoistNode):
+        return describe(node.val)
+    if isinstance(node, IdNode):
+        return node.id
+    if isinstance(node, ConstantNode):
+        return repr(node.value)
+    if isinstance(node, FunctionNode):
+        return '{}({})'.format(node.fun, ', '.join(describe(arg) for arg in node.args))
+    if isinstance(node, ComprehensionNode):
+        return '[{} where ...]'.format(describe(node.source))
+    return type(node).__name__
+
+
+def constraint_labels(tree):
+    """
+    Name every extraction and quota in a tree by its rarity, its position and what it draws from.
+    """
+    labels = {}
+
+    def walk(rarity, exprs):
+        for expr in exprs:
+            if isinstance(expr, RepeatNode):
+                walk(rarity, expr.exprs)
+            elif isinstance(expr, AssignNode) and expr.fun is random_assign:
+                labels[expr] = '{} #{} {} -> {}'.format(rarity.name, len(labels) + 1,
+                                                        describe(expr.val), expr.targets[0])
+            elif isinstance(expr, QuotaNode):
+                labels[expr] = '{} #{} Quota {} from {}'.format(rarity.name, len(labels) + 1,
+                                                                 expr.n, describe(expr.source))
+
+    for rarity in tree.lst:
+        walk(rarity, rarity.exprs)
+    return labels
+
+
+class Histogram():
+    """
+    Counts of small non-negative integers with their mean.
+    """
+    def __init__(self):
+        self.counts = Counter()
+        self.total = 0
+        self.n = 0
+
+    def add(self, value):
+        self.counts[value] += 1
+        self.total += value
+        self.n += 1
+
+    def mean(self):
+        return self.total / self.n if self.n else 0
+
+    def to_json(self):
+        return {'mean': self.mean(), 'counts': {str(k): v for k, v in sorted(self.counts.items())}}
+
+
+class ConstraintStats():
+    """
+    How much choice an extraction or quota had each time it was evaluated.
+
+    An extraction is tight when it had a single card to pick from, and a quota bound is tight when
+    exactly as many cards as it needs at least were left to meet it. Sizes are kept in power of two
+    buckets.
+    """
+    def __init__(self, label):
+        self.label = label
+        self.evals = 0
+        self.tight = 0
+        self.failures = 0
+        self.min_size = None
+        self.sizes = Histogram()
+
+    def add(self, size, tight):
+        self.evals += 1
+        self.tight += tight
+        self.min_size = size if self.min_size is None else min(self.min_size, size)
+        self.sizes.add(size.bit_length())
+
+    def to_json(self):
+        buckets = self.sizes.to_json()['counts']
+        return {'label': self.label, 'evals': self.evals, 'tight': self.tight,
+                'failures': self.failures, 'min_size': self.min_size,
+                'size_buckets': {'<{}'.format(1 << int(k)): v for k, v in buckets.items()}}
+
+
+class PoolStats():
+    """
+    Running statistics over every pack generated by a simulation.
+
+    Also serves as the observer of each run's Context, so it sees every extraction and quota.
+    """
+    def __init__(self, tree):
+        self.cards = tree.cards
+        self.constraints = {node: ConstraintStats(label)
+                            for node, label in constraint_labels(tree).items()}
+        self.appearances = array('l', [0]) * len(self.cards)
+        self.color_counts = {color: Histogram() for color in colors}
+        self.colors_per_pack = Histogram()
+        self.pack_sizes = Histogram()
+        self.packs = 0
+        self.runs = 0
+        self.failed_runs = 0
+        self.packs_before_failure = Histogram()
+        self.last = None
+
+    def extracting(self, node, lst):
+        self.last = node
+        stats = self.constraints.get(node)
+        if stats is not None:
+            stats.add(len(lst), len(lst) == 1)
+
+    def drawing_quota(self, node, candidates, bounds):
+        self.last = node
+        stats = self.constraints.get(node)
+        if stats is not None:
+            # A quota is as tight as its tightest bound
+            tight = any(low > 0 and sum(cd in members for cd in candidates) == low
+                        for low, _, members in bounds)
+            stats.add(len(candidates), tight)
+
+    def add_pack(self, pack):
+        self.packs += 1
+        self.pack_sizes.add(len(pack))
+        per_color = Counter()
+        for cd in pack:
+            self.appearances[cd] += 1
+            card_colors = mask_colors[self.cards.color_masks[cd]]
+            per_color.update(card_colors if card_colors else ['Colorless'])
+        for color in colors:
+            self.color_counts[color].add(per_color[color])
+        self.colors_per_pack.add(len(per_color) - ('Colorless' in per_color))
+
+    def add_failure(self, packs_made):
+        self.failed_runs += 1
+        self.packs_before_failure.add(packs_made)
+        stats = self.constraints.get(self.last)
+        if stats is not None:
+            stats.failures += 1
+
+    def card_summary(self):
+        """
+        Appearances per card in each rarity.
+        """
+        rarities = {}
+        for cd, fname in enumerate(self.cards.files):
+            rarities.setdefault(fname.split('/')[0], []).append(self.appearances[cd])
+        res = {}
+        for rarity, counts in sorted(rarities.items()):
+            res[rarity] = {'cards': len(counts), 'never_seen': counts.count(0), 'min': min(counts),
+                           'mean': sum(counts) / len(counts), 'max': max(counts)}
+        return res
+
+    def extreme_cards(self, n=10):
+        order = sorted(range(len(self.cards)),
+                       key=lambda cd: (self.appearances[cd], self.cards.names[cd]))
+        entry = lambda cd: {'name': self.cards.names[cd], 'appearances': self.appearances[cd]}
+        return {'least': [entry(cd) for cd in order[:n]],
+                'most': [entry(cd) for cd in order[::-1][:n]]}
+
+    def to_json(self):
+        return {
+            'runs': self.runs,
+            'packs': self.packs,
+            'failed_runs': self.failed_runs,
+            'packs_before_failure': self.packs_before_failure.to_json(),
+            'pack_size': self.pack_sizes.to_json(),
+            'colors_per_pack': self.colors_per_pack.to_json(),
+            'cards_per_color': {color: hist.to_json() for color, hist in self.color_counts.items()},
+            'cards': self.card_summary(),
+            'extreme_cards': self.extreme_cards(),
+            'constraints': [stats.to_json() for stats in self.constraints.values()],
+        }
+
+    def report(self, out=sys.stdout):
+        out.write('{} runs, {} packs, {} runs failed\n'.format(self.runs, self.packs,
+                                                             self.failed_runs))
+        if self.failed_runs:
+            out.write('Packs made before a failure: {:.1f} on average\n'
+                      .format(self.packs_before_failure.mean()))
+        out.write('Cards per pack: {:.2f}, colors per pack: {:.2f}\n\n'
+                  .format(self.pack_sizes.mean(), self.colors_per_pack.mean()))
+        out.write('Cards of each color per pack\n')
+        for color, hist in self.color_counts.items():
+            spread = ' '.join('{}:{}'.format(k, v) for k, v in sorted(hist.counts.items()))
+            out.write('  {:<10} mean {:5.2f}   {}\n'.format(color, hist.mean(), spread))
+        out.write('\nAppearances per card\n')
+        for rarity, summary in self.card_summary().items():
+            out.write('  {:<10} {cards:4} cards, {never_seen:4} never seen, min {min} '
+                      'mean {mean:.1f} max {max}\n'.format(rarity, **summary))
+        out.write('\nExtractions and quotas\n')
+        for stats in self.constraints.values():
+            out.write('  {}\n    evaluated {}, tight {}, failed {}, fewest choices {}\n'.format(
+                stats.label, stats.evals, stats.tight, stats.failures, stats.min_size))
+
+
+def simulate(tree, runs, packs_per_run, seed=None, stats=None):
+    """
+    Build packs_per_run packs runs times, each run from a full cube, gathering PoolStats.
+
+    A pack that cannot be built ends its run and is counted against the extraction or quota that
+    ran out of cards.
+    """
+    if stats is None:
+        stats = PoolStats(tree)
+    if seed is None:
+        seed = random.getrandbits(64)
+    compiled = compile_tree(tree)
+    for run in range(runs):
+        ctx = Context('{}:{}'.format(seed, run))
+        ctx.observer = stats
+        stats.runs += 1
+        for made in range(packs_per_run):
+            pack = []
+            try:
+                compiled.eval(pack, ctx)
+            except ValueError:
+                stats.add_failure(made)
+                break
+            stats.add_pack(pack)
+    return stats
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('def_file')
+    arg_parser.add_argument('runs', type=int, help='Number of times to build a full set of packs')
+    arg_parser.add_argument('packs_per_run', type=int, help='Packs built from the cube in each run')
+    arg_parser.add_argument('--seed', default=None, help='Seed to make the simulation reproducible')
+    arg_parser.add_argument('--json', action='store_true', help='Print the statistics as JSON')
+    args = arg_parser.parse_args()
+
+    try:
+        tree = create_tree(args.def_file)
+    except (DefError, OSError) as e:
+        sys.exit(str(e))
+    try:
+        stats = simulate(tree, args.runs, args.packs_per_run, args.seed)
+    except StatementError as e:
+        sys.exit(str(e))
+    if args.json:
+        json.dump(stats.to_json(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        stats.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Evaluating a tree must leave it ready to generate the next pack the same way.
+
+Run from anywhere with `python3 -m pytest tests` or `python3 -m unittest discover tests`.
+"""
+import os
+import sys
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, root)
+
+import parsertree  # noqa: E402
+
+start_dir = os.getcwd()
+
+
+def setUpModule():
+    os.chdir(root)
+
+
+def tearDownModule():
+    os.chdir(start_dir)
+
+
+class EvaluationTest(unittest.TestCase):
+    def test_file_names_survive_packs(self):
+        # Each pack extracts from FileNames, which would run out after one pack per rarity file
+        tree = parsertree.create_tree(os.path.join(here, 'filenames.def'), None)
+        files = len(tree.lst[0].file_names)
+        for evaluated in (tree, parsertree.compile_tree(tree)):
+            ctx = parsertree.Context(1)
+            for _ in range(files + 1):
+                pack = []
+                evaluated.eval(pack, ctx)
+                self.assertEqual(len(pack), 1)
+        self.assertEqual(len(tree.lst[0].file_names), files)
+
+
+    def test_exhausted_selection(self):
+        # Every card the comprehension selected was added before drawing from it, leaving no copies
+        tree = parsertree.create_tree(os.path.join(here, 'exhausted_selection.def'), None)
+        for evaluated in (tree, parsertree.compile_tree(tree)):
+            with self.assertRaisesRegex(parsertree.DefError, 'No copies left'):
+                evaluated.eval([], parsertree.Context(1))
+
+    def test_names_like_internal_slots(self):
+        # Names the evaluator once used for its own slots are ordinary variables in a def
+        tree = parsertree.create_tree(os.path.join(here, 'internal_names.def'), None)
+        for evaluated in (tree, parsertree.compile_tree(tree)):
+            pack = []
+            evaluated.eval(pack, parsertree.Context(1))
+            self.assertEqual(len(pack), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+GathererFetcher against a stand-in server on 127.0.0.1, so retries, redirects and rate limiting are
+checked without reaching Gatherer.
+
+Run from anywhere with `python3 -m pytest tests` or `python3 -m unittest discover tests`.
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from gatherer import GathererFetcher  # noqa: E402
+
+
+class StandIn():
+    """
+    An HTTP server answering each request with the next of responses, a (status, headers, body)
+    tuple, and recording the time and path of every request.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stand_in.requests.append((time.monotonic(), self.path))
+                status, headers, body = stand_in.responses.pop(0)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def paths(self):
+        return [path for _, path in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def ok(body=b'page'):
+    return 200, {}, body
+
+
+class FetcherTest(unittest.TestCase):
+    def stand_in(self, responses):
+        res = StandIn(responses)
+        self.addCleanup(res.close)
+        return res
+
+    def fetcher(self, stand_in, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        kwargs.setdefault('min_interval', 0)
+        return GathererFetcher(stand_in.url, timeout=5, **kwargs)
+
+    def test_retries_server_errors(self):
+        stand_in = self.stand_in([(503, {}, b''), (429, {}, b''), ok()])
+        self.assertEqual(self.fetcher(stand_in, retries=2).fetch_page('1'), b'page')
+        self.assertEqual(len(stand_in.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        stand_in = self.stand_in([(500, {}, b'')] * 3)
+        with self.assertRaisesRegex(IOError, 'HTTP 500'):
+            self.fetcher(stand_in, retries=2).fetch_page('1')
+        self.assertEqual(len(stand_in.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        stand_in = self.stand_in([(404, {}, b'')])
+        with self.assertRaisesRegex(IOError, 'HTTP 404'):
+            self.fetcher(stand_in, retries=2).fetch_page('1')
+        self.assertEqual(len(stand_in.requests), 1)
+
+    def test_follows_relative_redirect(self):
+        stand_in = self.stand_in([(302, {'Location': '/moved?multiverseid=1'}, b''), ok()])
+        self.assertEqual(self.fetcher(stand_in).fetch_page('1'), b'page')
+        self.assertEqual(stand_in.paths(), [GathererFetcher.details_path.format(1),
+                                            '/moved?multiverseid=1'])
+
+    def test_follows_redirect_to_other_host(self):
+        target = self.stand_in([ok(b'moved')])
+        stand_in = self.stand_in([(301, {'Location': target.url + '/card?id=1'}, b'')])
+        self.assertEqual(self.fetcher(stand_in).fetch_page('1'), b'moved')
+        self.assertEqual(target.paths(), ['/card?id=1'])
+
+    def test_redirects_use_up_tries(self):
+        stand_in = self.stand_in([(302, {'Location': '/again'}, b'')] * 2)
+        with self.assertRaisesRegex(IOError, 'HTTP 302'):
+            self.fetcher(stand_in, retries=1).fetch_page('1')
+        self.assertEqual(len(stand_in.requests), 2)
+
+    def test_spaces_requests(self):
+        interval = 0.05
+        stand_in = self.stand_in([ok()] * 6)
+        fetcher = self.fetcher(stand_in, min_interval=interval, workers=3)
+        _, errors = fetcher.fetch_all(list('123456'))
+        self.assertEqual(errors, {})
+        times = sorted(at for at, _ in stand_in.requests)
+        # Requests leave on schedule but arrive after connecting, so only the whole run is checked
+        self.assertGreater(times[-1] - times[0], interval * (len(times) - 1) * 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
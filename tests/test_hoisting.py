@@ -0,0 +1,56 @@
+"""
+Hoisting must leave the packs of a def file unchanged.
+
+Run from anywhere with `python3 -m pytest tests` or `python3 -m unittest discover tests`.
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, root)
+
+import parsertree  # noqa: E402
+
+start_dir = os.getcwd()
+
+
+def setUpModule():
+    # Rarity directories and the color cache are found relative to the working directory
+    os.chdir(root)
+
+
+def tearDownModule():
+    os.chdir(start_dir)
+
+
+def generate(def_file, hoist, seeds=range(20)):
+    if hoist:
+        tree = parsertree.create_tree(def_file, None)
+    else:
+        with mock.patch.object(parsertree, 'hoist_invariants', lambda tree: tree):
+            tree = parsertree.create_tree(def_file, None)
+    res = []
+    for seed in seeds:
+        pack = []
+        tree.eval(pack, parsertree.Context(seed))
+        res.append(pack)
+    return res
+
+
+class HoistingTest(unittest.TestCase):
+    def assert_unchanged(self, def_file):
+        self.assertEqual(generate(def_file, True), generate(def_file, False))
+
+    def test_extracting_through_alias(self):
+        # Left = Colors shares the list, so popping from Left changes what the comprehension reads
+        self.assert_unchanged(os.path.join(here, 'hoist_alias.def'))
+
+    def test_standard_pack(self):
+        self.assert_unchanged('standardpack.def')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Results written through resultwriter: appended files keep their parts in order, and writing the
+pools of many players does not hold a file open for each of them.
+
+Run from anywhere with `python3 -m pytest tests` or `python3 -m unittest discover tests`.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from packbuilder import write_dec_stream  # noqa: E402
+from resultwriter import open_results  # noqa: E402
+
+players = 300
+
+
+def packs(rounds=2):
+    for i in range(rounds * players):
+        yield ['1 [mvid:{}] Card {}\n'.format(i, i)]
+
+
+def open_descriptors():
+    # Only counted where the system lists them
+    if not os.path.isdir('/proc/self/fd'):
+        return 0
+    return len(os.listdir('/proc/self/fd'))
+
+
+class ResultWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.dest = os.path.join(self.dir, 'packs')
+        self.before = open_descriptors()
+
+    def write(self, archive=None):
+        with open_results(self.dest, archive, threads=1) as out:
+            write_dec_stream(packs(), out, players)
+            self.assertLess(open_descriptors() - self.before, 10)
+
+    def expected_pool(self, player):
+        return ''.join('1 [mvid:{0}] Card {0}\n'.format(i) for i in (player, player + players))
+
+    def test_directory(self):
+        self.write()
+        with open(os.path.join(self.dest, 'player-7', 'pool.dec')) as pool:
+            self.assertEqual(pool.read(), self.expected_pool(6))
+        with open(os.path.join(self.dest, 'player-7', 'pack-2.dec')) as pack:
+            self.assertEqual(pack.read(), '1 [mvid:306] Card 306\n')
+
+    def test_archive(self):
+        self.write('jsonl')
+        with open(self.dest + '.jsonl') as archive:
+            files = {entry['path']: entry['contents'] for entry in map(json.loads, archive)}
+        self.assertEqual(len(files), 3 * players)
+        self.assertEqual(files['player-7/pool.dec'], self.expected_pool(6))
+
+
+if __name__ == '__main__':
+    unittest.main()
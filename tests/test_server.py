@@ -0,0 +1,118 @@
+"""
+The pack server on 127.0.0.1: status codes for bad requests, packs matching packbuilder, and def
+files reloaded when they change.
+
+Run from anywhere with `python3 -m pytest tests` or `python3 -m unittest discover tests`.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from unittest import mock
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import server  # noqa: E402
+
+from packbuilder import generate_packs  # noqa: E402
+from parsertree import create_tree  # noqa: E402
+from treecache import TreeCache  # noqa: E402
+
+start_dir = os.getcwd()
+one_card = 'Commons: 1\n    Any -> Card\n    Add(Card)\n'
+
+
+def setUpModule():
+    # Rarity directories and the color cache are found relative to the working directory
+    os.chdir(root)
+
+
+def tearDownModule():
+    os.chdir(start_dir)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        # Def files are served from a scratch directory, which also holds the cached trees
+        self.def_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.def_dir)
+        cache_dir = os.path.join(self.def_dir, '.treecache')
+        cache = mock.patch.object(server, 'tree_cache', TreeCache(cache_dir))
+        cache.start()
+        self.addCleanup(cache.stop)
+        shutil.copy(os.path.join(root, 'standardpack.def'), self.def_dir)
+        self.write_def('broken.def', 'Commons: 1\n    Any ->\n')
+        self.store = server.TreeStore(self.def_dir)
+        self.server = server.make_server(self.store, '127.0.0.1', 0, quiet=True)
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def write_def(self, name, text):
+        with open(os.path.join(self.def_dir, name), 'w') as out:
+            out.write(text)
+
+    def get(self, path, **params):
+        url = 'http://127.0.0.1:{}{}?{}'.format(self.server.server_address[1], path,
+                                                 urllib.parse.urlencode(params))
+        try:
+            with urllib.request.urlopen(url, timeout=30) as resp:
+                return resp.status, json.load(resp)
+        except urllib.error.HTTPError as e:
+            with e:
+                return e.code, json.load(e)
+
+    def test_missing_def(self):
+        self.assertEqual(self.get('/packs')[0], 400)
+
+    def test_bad_count(self):
+        self.assertEqual(self.get('/packs', **{'def': 'standardpack.def', 'count': 0})[0], 400)
+        self.assertEqual(self.get('/packs', **{'def': 'standardpack.def', 'count': 'many'})[0], 400)
+
+    def test_def_outside_root(self):
+        self.assertEqual(self.get('/packs', **{'def': '../standardpack.def'})[0], 403)
+
+    def test_unknown_def(self):
+        self.assertEqual(self.get('/packs', **{'def': 'nothing.def'})[0], 404)
+
+    def test_broken_def(self):
+        status, body = self.get('/packs', **{'def': 'broken.def'})
+        self.assertEqual(status, 422)
+        self.assertIn('broken.def:', body['error'])
+
+    def test_packs_match_packbuilder(self):
+        params = {'def': 'standardpack.def', 'count': 3, 'seed': 5, 'format': 'dec'}
+        status, body = self.get('/packs', **params)
+        self.assertEqual(status, 200)
+        tree = create_tree(os.path.join(self.def_dir, 'standardpack.def'), None)
+        expected = generate_packs(tree, 3, '5')
+        self.assertEqual(body['packs'], [''.join(pack) for pack in expected])
+
+    def test_reloads_changed_def(self):
+        self.write_def('small.def', one_card)
+        status, body = self.get('/packs', **{'def': 'small.def', 'format': 'dec'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body['packs'][0].count('mvid:'), 1)
+        self.get('/packs', **{'def': 'small.def'})
+        self.assertEqual(self.get('/status')[1]['loads'], 1)
+
+        self.write_def('small.def', one_card + '    Any -> Other\n    Add(Other)\n')
+        status, body = self.get('/packs', **{'def': 'small.def', 'format': 'dec'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body['packs'][0].count('mvid:'), 2)
+        status = self.get('/status')[1]
+        self.assertEqual(status['loads'], 2)
+        self.assertEqual(status['trees']['small.def']['requests'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+The tree cache: entries are reused, and storing one removes those for a def file's old contents
+and those left unused.
+
+Run from anywhere with `python3 -m pytest tests` or `python3 -m unittest discover tests`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import treecache  # noqa: E402
+
+from parsertree import create_tree  # noqa: E402
+
+start_dir = os.getcwd()
+
+
+def setUpModule():
+    # Rarity directories and the color cache are found relative to the working directory
+    os.chdir(root)
+
+
+def tearDownModule():
+    os.chdir(start_dir)
+
+
+class TreeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = treecache.TreeCache(os.path.join(self.dir, 'trees'))
+        self.def_file = os.path.join(self.dir, 'cube.def')
+        with open(os.path.join(root, 'standardpack.def')) as inp:
+            self.contents = inp.read()
+        self.write_def(self.contents)
+
+    def write_def(self, text):
+        with open(self.def_file, 'w') as out:
+            out.write(text)
+
+    def entries(self):
+        return sorted({os.path.splitext(name)[0] for name in os.listdir(self.cache.cache_dir)})
+
+    def test_private_directory(self):
+        create_tree(self.def_file, self.cache)
+        self.assertEqual(os.stat(self.cache.cache_dir).st_mode & 0o077, 0)
+
+    def test_reused(self):
+        create_tree(self.def_file, self.cache)
+        create_tree(self.def_file, self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_edited_def_replaces_entry(self):
+        create_tree(self.def_file, self.cache)
+        first = self.entries()
+        self.write_def(self.contents + '\n')
+        create_tree(self.def_file, self.cache)
+        self.assertEqual(len(self.entries()), 1)
+        self.assertNotEqual(self.entries(), first)
+
+    def test_unused_entries_removed(self):
+        create_tree(self.def_file, self.cache)
+        old = os.path.join(self.cache.cache_dir, 'old-entry.pickle')
+        with open(old, 'wb'):
+            pass
+        os.utime(old, (0, 0))
+        create_tree(os.path.join(root, 'standardpack.def'), self.cache)
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(len(self.entries()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+A cache of parsed trees with their card tables, so an unchanged cube does not have to be read again.
+
+Entries are keyed by the path and contents of the .def file and the directory it is run from.
+Each entry records the size, mtime and hash of every file it was built from, and is only used
+while those still match. The cards of a cached tree are in a card database beside its entry.
+
+Entries are pickles, and loading a pickle can run any code, so the cache directory must only be
+writable by the user running packbuilder. It is kept under the user's cache directory rather than
+the directory packs are built from, and created readable by the user alone.
+"""
+import glob
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+import gatherer
+
+cache_version = 1
+# Entries not used for this long are removed when another is stored
+max_age = 30 * 24 * 3600
+source_modules = ['parsertree.py', 'cardtable.py', 'treecache.py']
+
+
+def file_digest(path):
+    with open(path, 'rb') as inp:
+        return hashlib.sha1(inp.read()).hexdigest()
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def colors_source():
+    """
+    The color cache the colors of loaded cards come from, or None if there is none yet.
+    """
+    path = os.path.abspath(gatherer.color_store.path)
+    return path if os.path.exists(path) else None
+
+
+def tree_sources(tree):
+    """
+    The files a loaded tree depends on: the .dec files of its rarities, the color cache and the code
+    that built it.
+    """
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    files = [os.path.join(code_dir, module) for module in source_modules]
+    for rarity in tree.lst:
+        files += sorted(glob.glob(rarity.name + '/*.dec'))
+    if colors_source() is not None:
+        files.append(colors_source())
+    return files
+
+
+def default_cache_dir():
+    """
+    The directory for cached trees under XDG_CACHE_HOME, or ~/.cache when that is not set.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sealed-cube', 'trees')
+
+
+def file_entry(path):
+    return file_stamp(path) + (file_digest(path),)
+
+
+def manifest(tree):
+    return {path: file_entry(path) for path in tree_sources(tree)}
+
+
+def is_fresh(tree, files):
+    """
+    Check that the files of a cached tree are the ones it was built from.
+
+    Unchanged sizes and mtimes are trusted, otherwise the contents are hashed so touching a file
+    does not throw the entry away.
+    """
+    try:
+        if set(tree_sources(tree)) != set(files):
+            return False
+        for path, (size, mtime, digest) in files.items():
+            if file_stamp(path) != (size, mtime) and file_digest(path) != digest:
+                return False
+    except OSError:
+        return False
+    return True
+
+
+class TreeCache():
+    """
+    Pickled trees in cache_dir, one file per key and working directory.
+
+    A key is the path of a .def file and its contents, separated by a NUL. Entry names start with a
+    hash of the path and working directory, so storing a tree for an edited .def file removes the
+    entry for its old contents.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def make_dir(self):
+        os.makedirs(self.cache_dir, 0o700, exist_ok=True)
+
+    def slot(self, key):
+        """
+        The start of the entry names for the .def file of key run from the working directory.
+        """
+        digest = hashlib.sha256()
+        digest.update('{}\0{}\0'.format(cache_version, os.getcwd()).encode())
+        digest.update(key.split('\0', 1)[0].encode())
+        return digest.hexdigest()[:32]
+
+    def path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, '{}-{}.pickle'.format(self.slot(key), digest))
+
+    def cards_path(self, key):
+        """
+        Where the card database of the tree for key is kept, next to its entry.
+        """
+        return self.path(key)[:-len('.pickle')] + '.cards'
+
+    def get(self, key):
+        """
+        The cached tree for a .def file, or None if there is none or it is out of date.
+        """
+        try:
+            with open(self.path(key), 'rb') as inp:
+                files, tree = pickle.load(inp)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError):
+            self.misses += 1
+            return None
+        if not is_fresh(tree, files):
+            self.misses += 1
+            return None
+        self.hits += 1
+        for path in (self.path(key), self.cards_path(key)):
+            try:
+                # Marks the entry as used so prune keeps it
+                os.utime(path)
+            except OSError:
+                pass
+        return tree
+
+    def put(self, key, files, tree):
+        """
+        Store a loaded tree with the manifest of its files taken before they were read.
+
+        The old entry is replaced atomically and failing to write is not an error.
+        """
+        try:
+            self.make_dir()
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    pickle.dump((files, tree), out, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.path(key))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.prune(key)
+        except OSError:
+            pass
+
+    def prune(self, key):
+        """
+        Remove the entries for other contents of the .def file of key, and any not used in max_age.
+        """
+        keep = os.path.basename(self.path(key))[:-len('.pickle')]
+        slot = self.slot(key)
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            entry, ext = os.path.splitext(name)
+            if entry == keep or ext not in ('.pickle', '.cards', '.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if entry.startswith(slot + '-') or now - os.stat(path).st_mtime > max_age:
+                    os.unlink(path)
+            except OSError:
+                # Already removed by another process, or still open where that is not allowed
+                pass
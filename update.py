@@ -1,23 +1,345 @@
 #!/usr/bin/env python3
 """
 Update the full files for each rarity.
+
+Only rarities whose .dec files changed since the last run are rebuilt, going by the sizes, mtimes
+and hashes kept in .update-manifest.json.
+
+Also seeds the color cache from local card data with `./update.py import-colors <source>` so pack
+generation never has to reach Gatherer.
 """
+import argparse
+import csv
 import glob
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from gatherer import card_mvid, color_store, colors, parse_color_identity
+from treecache import file_digest, file_stamp
+
+color_letters = {'W': 'White', 'U': 'Blue', 'B': 'Black', 'R': 'Red', 'G': 'Green',
+                 'C': 'Colorless'}
+color_names = {color.lower(): color for color in colors}
+mvid_keys = ['multiverseId', 'multiverseid', 'multiverse_id', 'multiverse_ids', 'mvid']
+color_keys = ['colorIdentity', 'color_identity', 'colors']
+manifest_file = '.update-manifest.json'
+manifest_version = 1
+
+
+def card_name(card_line):
+    return re.sub('^[0-9]+ ', '', card_line.strip())
+
+
+def read_dec(path):
+    """
+    The (comment, card) line pairs of a .dec file, and a comment line left at the end without a
+    card.
+    """
+    with open(path) as inp:
+        lines = [line if line.endswith('\n') else line + '\n' for line in inp]
+    pairs = [(lines[i], lines[i + 1]) for i in range(0, len(lines) - 1, 2)]
+    return pairs, lines[-1] if len(lines) % 2 else None
+
+
+def write_atomic(path, text):
+    """
+    Replace path with text through a temporary file, so it is never left half written.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as out:
+            out.write(text)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_manifest(path):
+    try:
+        with open(path) as inp:
+            manifest = json.load(inp)
+    except (OSError, ValueError):
+        manifest = None
+    if not isinstance(manifest, dict) or manifest.get('version') != manifest_version:
+        manifest = {'version': manifest_version, 'sources': {}, 'aggregates': {}}
+    return manifest
+
 
+def source_entry(path, previous):
+    """
+    The manifest entry of a .dec file, only reading it if it changed since previous.
+    """
+    stamp = list(file_stamp(path))
+    if previous is not None and previous['stamp'] == stamp:
+        return previous
+    digest = file_digest(path)
+    if previous is not None and previous['digest'] == digest:
+        return dict(previous, stamp=stamp)
+    pairs, _ = read_dec(path)
+    return {'stamp': stamp, 'digest': digest,
+            'cards': [[card_mvid(comment), card_name(card)] for comment, card in pairs]}
+
+
+def aggregate_is_fresh(path, sources, previous):
+    """
+    Whether the full file at path was built from sources, a dict of .dec file to digest, and is
+    intact.
+    """
+    if previous is None or previous['sources'] != sources:
+        return False
+    try:
+        if list(file_stamp(path)) == previous['stamp']:
+            return True
+        return file_digest(path) == previous['digest']
+    except OSError:
+        return False
+
+
+def build_aggregate(path, files):
+    """
+    Write the full file of a rarity from its .dec files, returning the (mvid, name) of its cards.
+    """
+    lines = []
+    cards = []
+    for rare_file in files:
+        pairs, dangling = read_dec(rare_file)
+        if dangling is not None:
+            print('{}: dropped {!r}, it has no card line after it'.format(rare_file,
+                                                                          dangling.strip()))
+        for comment, card in pairs:
+            lines += [comment, card]
+            cards.append([card_mvid(comment), card_name(card)])
+    write_atomic(path, ''.join(lines))
+    return cards
+
+
+def report_duplicates(sources):
+    """
+    Print every card that is in more than one .dec file.
+    """
+    files = defaultdict(list)
+    names = {}
+    for path, entry in sorted(sources.items()):
+        for mvid, name in entry['cards']:
+            files[mvid].append(path)
+            names[mvid] = name
+    for mvid, paths in files.items():
+        if len(paths) > 1:
+            print('{} (mvid {}) is duplicated in {}'.format(names[mvid], mvid, ', '.join(paths)))
+
+
+def main(force=False, manifest_path=manifest_file):
+    """
+    Create the full file of each rarity whose .dec files changed, or of every rarity with force.
 
-def main(rarity_file='rarities.yaml'):
+    Returns the full files that were rebuilt.
     """
-    Create full files for each rarity.
+    old = load_manifest(manifest_path)
+    manifest = {'version': manifest_version, 'sources': {}, 'aggregates': {}}
+    rebuilt = []
+    for rarity in sorted(glob.glob('*s/')):
+        files = sorted(glob.glob('{}*.dec'.format(rarity)))
+        if len(files) == 0:
+            continue
+        for rare_file in files:
+            manifest['sources'][rare_file] = source_entry(rare_file, old['sources'].get(rare_file))
+        out_path = '{}.dec'.format(rarity[:-1])
+        sources = {rare_file: manifest['sources'][rare_file]['digest'] for rare_file in files}
+        previous = old['aggregates'].get(out_path)
+        if not force and aggregate_is_fresh(out_path, sources, previous):
+            manifest['aggregates'][out_path] = previous
+            continue
+        cards = build_aggregate(out_path, files)
+        if previous is not None:
+            kept = {mvid for mvid, _ in cards}
+            for mvid, name in previous['cards']:
+                if mvid not in kept:
+                    print('{}: dropped {} (mvid {}), it is no longer in any of its files'
+                          .format(out_path, name, mvid))
+        manifest['aggregates'][out_path] = {'sources': sources, 'stamp': list(file_stamp(out_path)),
+                                            'digest': file_digest(out_path), 'cards': cards}
+        rebuilt.append(out_path)
+        print('Rebuilt {} with {} cards from {} files'.format(out_path, len(cards), len(files)))
+    report_duplicates(manifest['sources'])
+    write_atomic(manifest_path, json.dumps(manifest, indent=1, sort_keys=True))
+    if len(rebuilt) == 0:
+        print('Every rarity is up to date')
+    return rebuilt
+
+
+def cube_mvids():
+    """
+    The multiverse ids of every card in the rarity directories.
+    """
+    mvids = set()
+    for rare_file in glob.glob('*s/*.dec'):
+        with open(rare_file) as rfile:
+            for line in rfile:
+                if 'mvid:' in line:
+                    mvids.add(card_mvid(line))
+    return mvids
+
+
+def parse_colors(value):
+    """
+    Turn a color identity from a card dump into color names, with the tokens that were not colors.
+
+    Accepts lists or strings of either full names in any case ('White', 'white') or letters ('W',
+    'WU', 'W,U'). Anything else, like 'Gold' or 'none', is left out of the colors.
+    """
+    if isinstance(value, str):
+        value = re.findall('[A-Za-z]+', value)
+    elif not isinstance(value, list):
+        value = [value]
+    res = set()
+    unknown = []
+    for token in value:
+        if not isinstance(token, str):
+            unknown.append(token)
+        elif token.lower() in color_names:
+            res.add(color_names[token.lower()])
+        elif all(letter in color_letters for letter in token.upper()):
+            res.update(color_letters[letter] for letter in token.upper())
+        else:
+            unknown.append(token)
+    return res, unknown
+
+
+def record_mvids(record):
+    for key in mvid_keys:
+        value = record.get(key)
+        if value in (None, ''):
+            continue
+        if isinstance(value, list):
+            return [str(v) for v in value]
+        return [str(value)]
+    identifiers = record.get('identifiers')
+    if isinstance(identifiers, dict):
+        return record_mvids(identifiers)
+    return []
+
+
+def record_colors(record):
+    """
+    The colors of a record and the tokens among them that were not colors, or None if it has none.
+    """
+    for key in color_keys:
+        if key in record:
+            return parse_colors(record[key])
+    return None
+
+
+def iter_json_records(obj):
+    """
+    Find every card record in a JSON dump, whatever it is nested in.
+
+    Handles flat lists (Scryfall bulk data) as well as set/printing dictionaries (MTGJSON).
+    """
+    if isinstance(obj, dict):
+        if len(record_mvids(obj)) > 0 and record_colors(obj) is not None:
+            yield obj
+            return
+        obj = list(obj.values())
+    if isinstance(obj, list):
+        for val in obj:
+            yield from iter_json_records(val)
+
+
+def read_json_dump(path):
+    with open(path) as inp:
+        dump = json.load(inp)
+    res = {}
+    skipped = 0
+    for record in iter_json_records(dump):
+        card_colors, unknown = record_colors(record)
+        skipped += len(unknown) > 0
+        for mvid in record_mvids(record):
+            res[mvid] = card_colors
+    return res, skipped
+
+
+def read_csv_dump(path):
+    res = {}
+    skipped = 0
+    with open(path, newline='') as inp:
+        for record in csv.DictReader(inp):
+            parsed = record_colors(record)
+            if parsed is None:
+                continue
+            card_colors, unknown = parsed
+            skipped += len(unknown) > 0
+            for mvid in record_mvids(record):
+                for split_mvid in re.findall('[0-9]+', mvid):
+                    res[split_mvid] = card_colors
+    return res, skipped
+
+
+def read_html_page(path):
+    """
+    Parse a saved Gatherer details page named after the cards multiverse id.
+    """
+    mvid = re.findall('[0-9]+', os.path.basename(path))[-1]
+    with open(path, 'rb') as inp:
+        return mvid, parse_color_identity(inp.read())
+
+
+def read_html_pages(path, workers=None):
+    pages = [f for f in glob.glob(os.path.join(path, '*.htm*'))
+             if re.search('[0-9]', os.path.basename(f))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(read_html_page, pages, chunksize=16))
+
+
+def import_colors(source, all_cards=False, workers=None):
+    """
+    Seed the color cache from a JSON or CSV card dump or a directory of saved Gatherer pages.
+
+    Tokens in a dump that are not colors are left out of the card's colors and the records with
+    any are counted in the summary.
     """
-    for rarity in glob.glob('*s/'):
-        lines = []
-        for rare_file in glob.glob('{}*.dec'.format(rarity)):
-            with open(rare_file) as rfile:
-                lines += list(rfile.readlines())
-        if len(lines) > 0:
-            with open('{}.dec'.format(rarity[:-1]), 'w') as out_file:
-                out_file.write(''.join(lines))
+    skipped = 0
+    if os.path.isdir(source):
+        entries = read_html_pages(source, workers)
+    elif source.lower().endswith('.csv'):
+        entries, skipped = read_csv_dump(source)
+    else:
+        entries, skipped = read_json_dump(source)
+    wanted = cube_mvids()
+    if not all_cards:
+        entries = {mvid: val for mvid, val in entries.items() if mvid in wanted}
+    color_store.update(entries)
+    missing = [mvid for mvid in wanted if color_store.get(mvid) is None]
+    print('Imported {} cards, {} cube cards still missing, {} records with colors not recognized'
+          .format(len(entries), len(missing), skipped))
+    return missing
 
 
 if __name__ == '__main__':
-    main()
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('--force', action='store_true',
+                            help='Rebuild every rarity, changed or not')
+    subparsers = arg_parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser('import-colors',
+                                          help='Seed the color cache from local card data')
+    import_parser.add_argument('source',
+                               help='JSON/CSV card dump or directory of saved Gatherer pages')
+    import_parser.add_argument('--all', action='store_true',
+                               help='Keep cards that are not in the cube')
+    import_parser.add_argument('--workers', type=int, default=None,
+                               help='Processes used to parse pages')
+    args = arg_parser.parse_args()
+    if args.command == 'import-colors':
+        import_colors(args.source, args.all, args.workers)
+    else:
+        main(args.force)